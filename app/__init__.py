@@ -1,11 +1,12 @@
+import click
 from flask import Flask
 from config import Config
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
-from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import MetaData
-import boto3, botocore
+from app.database import SQLAlchemy
+from app.search import backends, default_backend
+from app.storage import S3
 import logging
 from logging.handlers import RotatingFileHandler
 import os
@@ -20,16 +21,11 @@ naming_convention = {
 }
 
 db = SQLAlchemy(metadata=MetaData(naming_convention=naming_convention))
-migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = 'Please log in to access this page.'
 bootstrap = Bootstrap()
-s3 = boto3.client(
-        "s3",
-        aws_access_key_id=Config.S3_KEY,
-        aws_secret_access_key=Config.S3_SECRET
-    )
+s3 = S3()
 
 
 def create_app(config_class=Config):
@@ -37,9 +33,20 @@ def create_app(config_class=Config):
     app.config.from_object(config_class)
     
     db.init_app(app)
-    migrate.init_app(app, db, render_as_batch=True)
+    # Alembic is slow to import and only the `flask db` commands need it
+    if click.get_current_context(silent=True) is not None:
+        init_migrate(app)
     login.init_app(app)
     bootstrap.init_app(app)
+    s3.init_app(app)
+    backend = app.config['SEARCH_BACKEND'] or default_backend(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.search_index = backends[backend]() if backend in backends else None
+
+    from app.cache import fragment_cache
+    fragment_cache.init_app(app)
+
+    from app.uploads import uploads
+    uploads.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -66,4 +73,9 @@ def create_app(config_class=Config):
     return app
 
 
+def init_migrate(app):
+    from flask_migrate import Migrate
+    Migrate(app, db, render_as_batch=True)
+
+
 from app import models
@@ -0,0 +1,323 @@
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+from itertools import chain
+from flask import current_app
+from sqlalchemy import inspect
+from app import db
+
+
+# Write tracking
+#
+# Every flush records the tables it touched in session.info, including the
+# association tables behind changed many-to-many collections. Code that writes
+# with Core statements records its tables through mark_changed. Change hooks
+# run inside the transaction as tables are marked; when the transaction
+# commits, each commit hook receives the set of changed table names so caches
+# can drop exactly what went stale; a rollback discards it.
+
+change_hooks = []
+commit_hooks = []
+
+
+def mark_changed(session, *tables):
+    tables = set(tables)
+    session.info.setdefault('changed_tables', set()).update(tables)
+    for hook in change_hooks:
+        hook(session, tables)
+
+
+def track_flush(session, flush_context):
+    tables = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        state = inspect(obj)
+        if obj not in session.dirty or session.is_modified(obj, include_collections=False):
+            tables.add(state.mapper.local_table.name)
+        for relationship in state.mapper.relationships:
+            if relationship.secondary is not None and (obj in session.deleted or
+                    state.attrs[relationship.key].history.has_changes()):
+                tables.add(relationship.secondary.name)
+    if tables:
+        mark_changed(session, *tables)
+
+
+def run_commit_hooks(session):
+    tables = session.info.pop('changed_tables', None)
+    if tables:
+        for hook in commit_hooks:
+            hook(tables)
+
+
+def discard_changes(session):
+    session.info.pop('changed_tables', None)
+
+
+db.event.listen(db.session, 'after_flush', track_flush)
+db.event.listen(db.session, 'after_commit', run_commit_hooks)
+db.event.listen(db.session, 'after_rollback', discard_changes)
+
+
+class ChoiceCache(object):
+    """Process-wide (id, label) option lists for relationship select fields
+
+    Entries are dropped when a commit touches one of their tables and expire
+    after CHOICES_CACHE_TIMEOUT seconds, which bounds how long other worker
+    processes can serve options that predate a write.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._generations = Counter()
+
+    def get(self, key, tables, loader):
+        """Return (choices, ids) for `key`, calling `loader` to rebuild a missing entry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = [self._generations[table] for table in tables]
+        if entry is None or entry[0] < time.monotonic():
+            choices = loader()
+            entry = (time.monotonic() + current_app.config['CHOICES_CACHE_TIMEOUT'], frozenset(tables),
+                choices, frozenset(id for id, label in choices))
+            with self._lock:
+                # a commit while loading may have made these choices stale
+                if generation == [self._generations[table] for table in tables]:
+                    self._entries[key] = entry
+        return entry[2], entry[3]
+
+    def invalidate(self, tables):
+        with self._lock:
+            self._generations.update(tables)
+            for key in [key for key, entry in self._entries.items() if entry[1] & tables]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.update(self._generations.keys())
+
+
+choice_cache = ChoiceCache()
+commit_hooks.append(choice_cache.invalidate)
+
+
+class LRUCache(object):
+    """In-process least-recently-used cache bounded by the total size of its values in bytes"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return []
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = value
+            self.size += len(value)
+            evicted = []
+            while self.size > self.max_bytes:
+                old_key, old_value = self._entries.popitem(last=False)
+                self.size -= len(old_value)
+                evicted.append(old_key)
+            return evicted
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def clear(self, prefix=''):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
+
+
+class RedisCache(object):
+    """Cache kept in a Redis-compatible server, shared by every worker process"""
+    def __init__(self, url, timeout):
+        import redis
+        self._client = redis.Redis.from_url(url)
+        self.timeout = timeout
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, value):
+        self._client.set(key, value, ex=self.timeout)
+        return []
+
+    def delete_many(self, keys):
+        if keys:
+            self._client.delete(*keys)
+
+    def add_to_index(self, index, key):
+        pipe = self._client.pipeline()
+        pipe.sadd(index, key)
+        pipe.expire(index, self.timeout)
+        pipe.execute()
+
+    def pop_index(self, index):
+        pipe = self._client.pipeline()
+        pipe.smembers(index)
+        pipe.delete(index)
+        return pipe.execute()[0]
+
+    def clear(self, prefix):
+        keys = list(self._client.scan_iter(match=prefix + '*'))
+        self.delete_many(keys)
+
+
+class FragmentCache(object):
+    """
+    Rendered HTML fragments keyed by their inputs plus the versions of the
+    tables they show, so a write can never be served stale. Each fragment is
+    also indexed under those tables, and commits drop exactly the fragments
+    built from the tables they changed instead of waiting for eviction.
+    """
+    prefix = 'library:fragment:'
+
+    def __init__(self):
+        self.backend = None
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        if app.config['FRAGMENT_CACHE_URL']:
+            self.backend = RedisCache(app.config['FRAGMENT_CACHE_URL'], app.config['FRAGMENT_CACHE_TIMEOUT'])
+        elif app.config['FRAGMENT_CACHE_BYTES']:
+            self.backend = LRUCache(app.config['FRAGMENT_CACHE_BYTES'])
+        else:
+            self.backend = None
+        with self._lock:
+            self._index = {}
+
+    def key(self, parts):
+        return self.prefix + hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def get_or_render(self, tables, parts, render):
+        """Return the cached fragment for `parts`, calling `render` and storing the result on a miss"""
+        if self.backend is None:
+            return render()
+
+        key = self.key(parts)
+        value = self.backend.get(key)
+        if value is not None:
+            return value.decode('utf-8')
+
+        fragment = render()
+        evicted = self.backend.set(key, fragment.encode('utf-8'))
+        self._add_to_index(tables, key, evicted)
+        return fragment
+
+    def invalidate(self, tables):
+        if self.backend is None:
+            return
+
+        keys = set()
+        if isinstance(self.backend, RedisCache):
+            for table in tables:
+                keys.update(self.backend.pop_index(self.prefix + 'table:' + table))
+        else:
+            with self._lock:
+                for table in tables:
+                    keys.update(self._index.pop(table, ()))
+                self._forget(keys)
+        self.backend.delete_many(list(keys))
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear(self.prefix)
+        with self._lock:
+            self._index = {}
+
+    def _add_to_index(self, tables, key, evicted):
+        if isinstance(self.backend, RedisCache):
+            for table in tables:
+                self.backend.add_to_index(self.prefix + 'table:' + table, key)
+            return
+
+        with self._lock:
+            for table in tables:
+                self._index.setdefault(table, set()).add(key)
+            self._forget(evicted)
+
+    def _forget(self, keys):
+        if keys:
+            keys = set(keys)
+            for table in list(self._index):
+                self._index[table] -= keys
+                if not self._index[table]:
+                    del self._index[table]
+
+
+fragment_cache = FragmentCache()
+commit_hooks.append(fragment_cache.invalidate)
+
+
+class UserCache(object):
+    """
+    Column values of recently authenticated users, so the login manager can
+    rebuild a detached User per request without a query. Entries expire after
+    USER_CACHE_TIMEOUT seconds, the least recently used are evicted past
+    USER_CACHE_SIZE, and any committed write to the user table drops them all.
+    """
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, id, loader):
+        """Return the cached values for user `id`, calling `loader(id)` on a miss"""
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._entries.move_to_end(id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        values = loader(id)
+        if values is not None:
+            with self._lock:
+                # a commit while loading may have made these values stale
+                if generation == self._generation:
+                    self._entries[id] = (time.monotonic() + current_app.config['USER_CACHE_TIMEOUT'], values)
+                    self._entries.move_to_end(id)
+                    while len(self._entries) > current_app.config['USER_CACHE_SIZE']:
+                        self._entries.popitem(last=False)
+        return values
+
+    def invalidate(self, tables):
+        if 'user' in tables:
+            self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries),
+            'hit_rate': self.hits / lookups if lookups else None}
+
+
+user_cache = UserCache()
+commit_hooks.append(user_cache.invalidate)
@@ -0,0 +1,98 @@
+import os
+import click
+from flask import current_app
+from app import db
+from app.importer import importable, import_file
+from app.models import counters, sort_keys, Upload
+from app.related import relations, refresh, sparse_available
+from app.startup import STARTUP_STATEMENT, import_profile, package_totals
+from app.uploads import uploads
+
+
+def register(app):
+    @app.cli.group()
+    def library():
+        """Catalog maintenance commands."""
+        pass
+
+    @library.command('import')
+    @click.argument('model', type=click.Choice(sorted(importable)))
+    @click.argument('file', type=click.File('r', encoding='utf-8'))
+    @click.option('--format', type=click.Choice(['csv', 'jsonl']),
+        help='File format; guessed from the file extension by default.')
+    @click.option('--batch-size', default=1000, show_default=True,
+        help='Records inserted per transaction.')
+    def import_(model, file, format, batch_size):
+        """Bulk import MODEL records from a CSV or JSONL file."""
+        if format is None:
+            format = 'csv' if os.path.splitext(file.name)[1].lower() == '.csv' else 'jsonl'
+
+        report = import_file(importable[model], file, format, batch_size)
+
+        for number, message in report.errors:
+            click.echo('Record {}: {}'.format(number, message), err=True)
+        for number, message in report.conflicts:
+            click.echo('Record {}: conflict: {}'.format(number, message), err=True)
+        click.echo('Imported {} {} record(s); {} conflict(s), {} error(s)'.format(
+            report.inserted, model, len(report.conflicts), len(report.errors)))
+
+    @library.command('resume-uploads')
+    @click.option('--failed', is_flag=True, help='Also retry uploads that failed, if their spool file was kept.')
+    def resume_uploads(failed):
+        """Requeue spooled uploads a restart left unfinished.
+
+        Run it while no app server is transferring, or their in-flight
+        uploads are sent twice.
+        """
+        resumed = uploads.resume(('pending', 'uploading', 'failed') if failed else ('pending', 'uploading'))
+        uploads.wait()
+        for upload in Upload.query.filter(Upload.id.in_(resumed)).order_by(Upload.id):
+            click.echo('Upload {} ({}): {}'.format(upload.id, upload.filename, upload.status))
+        click.echo('Resumed {} upload(s)'.format(len(resumed)))
+
+    @library.command('clean-uploads')
+    @click.option('--older-than', type=float, help='Age in hours; UPLOAD_SPOOL_RETENTION by default.')
+    def clean_uploads(older_than):
+        """Delete spool files of failed or abandoned uploads."""
+        max_age = older_than * 3600 if older_than is not None else current_app.config['UPLOAD_SPOOL_RETENTION']
+        click.echo('Removed {} spool file(s)'.format(uploads.clean(max_age)))
+
+    @library.command()
+    def recount():
+        """Rebuild the denormalized relationship counts and sort keys."""
+        for counter in counters:
+            counter.recount(db.session)
+            click.echo('Recounted {}.{}'.format(counter.model.__tablename__, counter.name))
+        for sort_key in sort_keys:
+            sort_key.refresh(db.session)
+            click.echo('Refreshed {}.{}'.format(sort_key.model.__tablename__, sort_key.column.key))
+        db.session.commit()
+
+    @library.command()
+    @click.option('--kind', type=click.Choice(sorted(relations)), multiple=True,
+        help='Related items to refresh; all kinds by default.')
+    @click.option('--full', is_flag=True, help='Recompute every row instead of only the changed ones.')
+    @click.option('--top-k', type=int, help='Neighbors kept per row; RELATED_TOP_K by default.')
+    def related(kind, full, top_k):
+        """Refresh the related characters and tags."""
+        top_k = top_k or current_app.config['RELATED_TOP_K']
+        for name in kind or sorted(relations):
+            count = refresh(name, top_k, full)
+            click.echo('Refreshed related {}s for {} row(s)'.format(name, count))
+        if not sparse_available():
+            click.echo('NumPy/SciPy not installed; counted in Python', err=True)
+
+    @library.command()
+    @click.option('--limit', default=15, show_default=True, help='Packages to list.')
+    @click.option('--budget', type=float, help='Fail if imports take longer than this many milliseconds.')
+    def importtime(limit, budget):
+        """Report which packages make app startup slow."""
+        rows = import_profile(STARTUP_STATEMENT)
+        total = sum(self_us for module, self_us, cumulative_us, depth in rows) / 1000
+
+        for package, self_us in package_totals(rows)[:limit]:
+            click.echo('{:>9.1f} ms  {}'.format(self_us / 1000, package))
+        click.echo('{:>9.1f} ms  total for {} modules'.format(total, len(rows)))
+
+        if budget is not None and total > budget:
+            raise click.ClickException('Import time {:.1f} ms is over the {:.1f} ms budget'.format(total, budget))
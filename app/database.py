@@ -0,0 +1,103 @@
+import re
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+# SQLite engine profile
+#
+# Every new SQLite connection gets the SQLITE_PRAGMAS from the app config
+# (WAL journaling, relaxed fsyncs, a busy timeout, mmap and page cache sizes,
+# foreign key enforcement), and file databases keep a pool of connections
+# sized by SQLALCHEMY_ENGINE_OPTIONS instead of Flask-SQLAlchemy's NullPool,
+# so those per-connection settings and caches survive between requests.
+#
+# pysqlite commits on its own before DDL, which breaks SAVEPOINT, so the
+# connection is put in autocommit mode and transactions are started
+# explicitly instead, as the SQLAlchemy docs recommend. Like pysqlite, reads
+# run outside a transaction and the first write starts one, but with BEGIN
+# IMMEDIATE: a deferred transaction that has read and then tries to write
+# fails at once with "database is locked" when another writer got in first,
+# where an immediate one takes the write lock up front and waits out
+# busy_timeout for it.
+#
+# Sessions can also read from a replica: while session.info['replica'] is
+# set, queries go to the 'replica' bind from SQLALCHEMY_BINDS, if there is
+# one. Flushes and Core inserts/updates/deletes always go to the primary.
+
+pool_options = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+
+
+def sqlite_pragmas(pragmas):
+    """Return a connect listener that applies `pragmas` to each new DBAPI connection"""
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+    return connect
+
+
+read_statement = re.compile(r'\s*(SELECT|WITH|PRAGMA|EXPLAIN)\b', re.IGNORECASE)
+write_keyword = re.compile(r'\b(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+
+def begin_on_write(conn, cursor, statement, parameters, context, executemany):
+    """Start an immediate transaction before the first statement that isn't a plain read"""
+    if cursor.connection.in_transaction:
+        return
+    if read_statement.match(statement) and not write_keyword.search(statement):
+        return
+    cursor.execute('BEGIN IMMEDIATE')
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('replica') and not self._flushing and not (clause is not None and clause.is_dml):
+            replica = self.db.replica_engine(self.app)
+            if replica is not None:
+                return replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    def __init__(self, *args, **kwargs):
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+        self._pragmas = {}
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def replica_engine(self, app):
+        """Return the engine of the read replica, or None when none is configured"""
+        if 'replica' not in (app.config['SQLALCHEMY_BINDS'] or {}):
+            return None
+        return self.get_engine(app, bind='replica')
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super(SQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            self._pragmas[str(sa_url)] = app.config['SQLITE_PRAGMAS']
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = self._pragmas.get(str(sa_url))
+        if pragmas is not None:
+            if engine_opts.get('poolclass') is StaticPool:
+                # an in-memory database lives in its single connection
+                engine_opts = {k: v for k, v in engine_opts.items() if k not in pool_options}
+            elif engine_opts.get('pool_size'):
+                # pooled connections are handed to one thread at a time, but not always the one that opened them
+                engine_opts = dict(engine_opts, poolclass=QueuePool,
+                    connect_args=dict(engine_opts.get('connect_args', {}), check_same_thread=False))
+
+        engine = super(SQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if pragmas is not None:
+            event.listen(engine, 'connect', sqlite_pragmas(pragmas))
+            event.listen(engine, 'before_cursor_execute', begin_on_write)
+        return engine
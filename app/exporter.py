@@ -0,0 +1,97 @@
+import csv
+import io
+import json
+from itertools import islice
+from sqlalchemy import select
+from sqlalchemy.orm import class_mapper, joinedload
+from sqlalchemy.orm.interfaces import MANYTOONE
+from app import db
+from app.models import Tag
+
+
+# Streaming catalog export
+#
+# Rows are read through a server-side cursor (yield_per) and written out a
+# chunk at a time, so memory stays flat however large the table is. Each chunk
+# costs one query for the rows (with their many-to-one relationships joined in)
+# and one for the tags of every row in it.
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def export_fields(ResourceClass):
+    """Return (column names, many-to-one relationship names, whether tags are exported)"""
+    mapper = class_mapper(ResourceClass)
+    columns = [column.key for column in ResourceClass.__table__.columns if not column.info.get('sort_key')]
+    relationships = [r.key for r in mapper.relationships if r.direction is MANYTOONE]
+    return columns, relationships, 'tags' in mapper.relationships
+
+
+def tag_names(ResourceClass, ids):
+    """Map each id in `ids` to the names of its tags with a single query"""
+    prop = ResourceClass.tags.property
+    owner = prop.synchronize_pairs[0][1]
+    names = {id: [] for id in ids}
+    rows = db.session.execute(select(owner, Tag.name)
+        .join(Tag, Tag.id == prop.secondary_synchronize_pairs[0][1])
+        .where(owner.in_(ids)).order_by(owner, Tag.name))
+    for id, name in rows:
+        names[id].append(name)
+    return names
+
+
+def export_records(ResourceClass, batch_size=EXPORT_BATCH_SIZE):
+    """Yield one flat dict per row, with relationship names and tag lists denormalized"""
+    columns, relationships, tagged = export_fields(ResourceClass)
+    query = ResourceClass.query.options(*[joinedload(getattr(ResourceClass, name)) for name in relationships]) \
+        .order_by(ResourceClass.id).yield_per(batch_size)
+
+    rows = iter(query)
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            return
+
+        tags = tag_names(ResourceClass, [row.id for row in chunk]) if tagged else {}
+        for row in chunk:
+            record = {name: getattr(row, name) for name in columns}
+            for name in relationships:
+                related = getattr(row, name)
+                record[name] = related.label() if related is not None else None
+            if tagged:
+                record['tags'] = tags[row.id]
+            yield record
+
+
+def to_csv(ResourceClass, records):
+    columns, relationships, tagged = export_fields(ResourceClass)
+    header = columns + relationships + (['tags'] if tagged else [])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+
+    for i, record in enumerate(records, 1):
+        if tagged:
+            record['tags'] = ';'.join(record['tags'])
+        writer.writerow([record[name] for name in header])
+        if i % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def to_ndjson(ResourceClass, records):
+    lines = []
+    for i, record in enumerate(records, 1):
+        lines.append(json.dumps(record) + '\n')
+        if i % EXPORT_BATCH_SIZE == 0:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+formats = {
+    'csv': (to_csv, 'text/csv'),
+    'ndjson': (to_ndjson, 'application/x-ndjson'),
+}
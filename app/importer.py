@@ -0,0 +1,154 @@
+import csv
+import json
+from itertools import islice
+from sqlalchemy import exc, func, Boolean, Integer
+from app import db
+from app.cache import mark_changed
+from app.models import Actor, Art, Author, Book, Character, Series, Universe, full_name, recount_rows, refresh_sort_keys
+
+
+# Bulk catalog import
+#
+# Records are streamed from CSV/JSONL, relationship names (series, author, ...)
+# are resolved to foreign keys through lookup maps loaded once per import, and
+# each batch goes in as one executemany insert inside its own transaction. If a
+# batch trips a unique constraint it is retried row by row in savepoints so only
+# the conflicting records are skipped and reported.
+
+importable = {
+    'actor': Actor,
+    'art': Art,
+    'author': Author,
+    'book': Book,
+    'character': Character,
+    'series': Series,
+    'universe': Universe,
+}
+
+# Relationship fields an import file may name instead of giving the raw foreign key
+lookup_fields = {
+    Book: {'universe': ('universe_id', Universe), 'series': ('series_id', Series),
+        'author': ('author_id', Author), 'coauthor': ('coauthor_id', Author)},
+    Character: {'universe': ('universe_id', Universe), 'series': ('series_id', Series)},
+    Series: {'universe': ('universe_id', Universe)},
+}
+
+
+def lookup_map(ResourceClass):
+    """Map display names to ids for a lookup target, loading only the columns needed"""
+    if ResourceClass is Author:
+        rows = db.session.query(Author.id, Author.first_name, Author.middle_name, Author.last_name, Author.suffix)
+        return {full_name(*row[1:]): row.id for row in rows}
+    return {title: id for id, title in db.session.query(ResourceClass.id, ResourceClass.title)}
+
+
+def read_records(file, format):
+    """Yield (record number, dict) pairs from an open CSV or JSONL file"""
+    if format == 'csv':
+        for number, record in enumerate(csv.DictReader(file), 1):
+            yield number, record
+    else:
+        # lines are parsed in Importer.prepare so a bad line is reported, not fatal
+        for number, line in enumerate((line for line in file if line.strip()), 1):
+            yield number, line
+
+
+class ImportReport(object):
+    def __init__(self):
+        self.inserted = 0
+        self.conflicts = []
+        self.errors = []
+
+    def conflict(self, number, message):
+        self.conflicts.append((number, message))
+
+    def error(self, number, message):
+        self.errors.append((number, message))
+
+
+class Importer(object):
+    def __init__(self, ResourceClass, batch_size=1000):
+        self.ResourceClass = ResourceClass
+        self.table = ResourceClass.__table__
+        self.batch_size = batch_size
+        self.columns = [c for c in self.table.columns if not c.primary_key and not c.info.get('sort_key')]
+        self.lookups = {name: (key, lookup_map(target))
+            for name, (key, target) in lookup_fields.get(ResourceClass, {}).items()}
+        self.report = ImportReport()
+
+    def convert(self, column, value):
+        if isinstance(value, (list, dict)):
+            raise ValueError('{} must be a single value'.format(column.key))
+        if value is None or value == '':
+            return column.default.arg if column.default is not None and column.default.is_scalar else None
+        if isinstance(column.type, Integer):
+            return int(value)
+        if isinstance(column.type, Boolean):
+            return value if isinstance(value, bool) else str(value).lower() in ('1', 'true', 'yes')
+        return value
+
+    def prepare(self, record):
+        """Build a full insert row from a record, resolving relationship names to ids"""
+        record = json.loads(record) if isinstance(record, str) else dict(record)
+        if not isinstance(record, dict):
+            raise ValueError('expected an object')
+        # csv.DictReader collects fields past the header under a None key
+        extra = record.pop(None, None)
+        if extra:
+            raise KeyError('{:d} field(s) past the header'.format(len(extra)))
+
+        for name, (key, ids) in self.lookups.items():
+            label = record.pop(name, None)
+            if label:
+                if not isinstance(label, str) or label not in ids:
+                    raise LookupError('unknown {} "{}"'.format(name, label))
+                record[key] = ids[label]
+
+        unknown = set(record) - set(c.key for c in self.columns) - {'id'}
+        if unknown:
+            raise KeyError('unknown field(s) {}'.format(', '.join(sorted(map(str, unknown)))))
+        return {c.key: self.convert(c, record.get(c.key)) for c in self.columns}
+
+    def run(self, records):
+        records = iter(records)
+        while True:
+            chunk = list(islice(records, self.batch_size))
+            if not chunk:
+                return self.report
+
+            batch = []
+            for number, record in chunk:
+                try:
+                    batch.append((number, self.prepare(record)))
+                except (LookupError, KeyError, ValueError) as e:
+                    self.report.error(number, e.args[0])
+            if batch:
+                self.insert(batch)
+
+    def insert(self, batch):
+        last_id = db.session.query(func.max(self.ResourceClass.id)).scalar() or 0
+        inserted = []
+        try:
+            with db.session.begin_nested():
+                db.session.execute(self.table.insert(), [row for number, row in batch])
+            inserted = [row for number, row in batch]
+        except exc.IntegrityError:
+            for number, row in batch:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(self.table.insert(), row)
+                    inserted.append(row)
+                except exc.IntegrityError as e:
+                    self.report.conflict(number, str(e.orig))
+        self.report.inserted += len(inserted)
+
+        # Core inserts skip the session's flush listeners, so index, count and sort-key the new rows here
+        self.ResourceClass.reindex('id > {:d}'.format(last_id))
+        recount_rows(db.session, self.table, inserted)
+        refresh_sort_keys(db.session, self.ResourceClass, self.table.c.id > last_id)
+        mark_changed(db.session, self.table.name)
+        db.session.commit()
+
+
+def import_file(ResourceClass, file, format, batch_size=1000):
+    return Importer(ResourceClass, batch_size).run(read_records(file, format))
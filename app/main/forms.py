@@ -1,29 +1,139 @@
-from flask import current_app
+from flask import current_app, url_for
+from markupsafe import Markup
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, SelectField
-from wtforms.ext.sqlalchemy.fields import QuerySelectField
-from wtforms.fields.core import IntegerField
+from wtforms import widgets
+from wtforms.fields.core import IntegerField, SelectFieldBase
 from wtforms.fields.simple import TextAreaField
 from wtforms.validators import ValidationError, Required, DataRequired, Email, EqualTo, Optional
-from app.models import Actor, Art, Author, Book, Character, Series, Universe
+from app.models import Actor, Art, Author, Book, Character, Series, Universe, full_name
+from app.cache import choice_cache
 from app import db
 
 
-def author_choices():      
-    return db.session.query(Author).order_by('last_name', 'first_name')
-
-def book_choices():      
-    return db.session.query(Book).order_by('title')
-
-def character_choices():      
-    return db.session.query(Character).order_by('last_name', 'first_name')
-
-def series_choices():      
-    return db.session.query(Series).order_by('title')
-
-def universe_choices():      
-    return db.session.query(Universe).order_by('title')
+# Choice loaders return lightweight (id, label) tuples, cached in choice_cache
+
+def author_choices():
+    rows = db.session.query(Author.id, Author.first_name, Author.middle_name, Author.last_name, Author.suffix) \
+        .order_by(Author.last_name, Author.first_name)
+    return [(row.id, full_name(*row[1:])) for row in rows]
+
+def book_choices():
+    return db.session.query(Book.id, Book.title).order_by(Book.title).all()
+
+def character_choices():
+    rows = db.session.query(Character.id, Character.first_name, Character.last_name, Character.suffix) \
+        .order_by(Character.last_name, Character.first_name)
+    choices = []
+    for id, first_name, last_name, suffix in rows:
+        last = last_name + ' ' + suffix if suffix else last_name
+        choices.append((id, first_name + ' ' + last if last else first_name))
+    return choices
+
+def series_choices():
+    return db.session.query(Series.id, Series.title).order_by(Series.title).all()
+
+def universe_choices():
+    return db.session.query(Universe.id, Universe.title).order_by(Universe.title).all()
+
+
+class CachedSelectField(SelectFieldBase):
+    """
+    Select field for a many-to-one relationship whose options come from the
+    shared choice cache instead of a per-render query. Like QuerySelectField,
+    `data` is the related model instance, but it is only loaded (by primary
+    key) when it is actually read.
+    """
+    widget = widgets.Select()
+
+    def __init__(self, label=None, validators=None, model=None, choices=None, allow_blank=False, blank_text='', **kwargs):
+        super(CachedSelectField, self).__init__(label, validators, **kwargs)
+        self.model = model
+        self.choice_loader = choices
+        self.allow_blank = allow_blank
+        self.blank_text = blank_text
+        self._id = None
+        self._data = None
+
+    def _choices(self):
+        return choice_cache.get(self.choice_loader.__name__, [self.model.__tablename__], self.choice_loader)
+
+    def _get_data(self):
+        if self._data is None and self._id is not None:
+            self._data = self.model.query.get(self._id)
+        return self._data
+
+    def _set_data(self, data):
+        self._data = data
+        self._id = data.id if data is not None else None
+
+    data = property(_get_data, _set_data)
+
+    def iter_choices(self):
+        if self.allow_blank:
+            yield ('__None', self.blank_text, self._id is None)
+
+        for id, label in self._choices()[0]:
+            yield (id, label, id == self._id)
+
+    def process_formdata(self, valuelist):
+        if valuelist:
+            self._data = None
+            if self.allow_blank and valuelist[0] == '__None':
+                self._id = None
+            else:
+                try:
+                    self._id = int(valuelist[0])
+                except ValueError:
+                    self._id = None
+                    raise ValueError(self.gettext('Not a valid choice'))
+
+    def pre_validate(self, form):
+        if self._id is None:
+            if not self.allow_blank:
+                raise ValidationError(self.gettext('Not a valid choice'))
+        elif self._id not in self._choices()[1]:
+            raise ValidationError(self.gettext('Not a valid choice'))
+
+
+class AutocompleteWidget(object):
+    """Hidden input carrying the selected id plus a text box that script.js wires to the autocomplete API"""
+    def __call__(self, field, **kwargs):
+        kwargs.setdefault('id', field.id)
+        kwargs.setdefault('type', 'text')
+        kwargs.setdefault('autocomplete', 'off')
+        kwargs['data-autocomplete'] = url_for('main.autocomplete', model=field.model.__tablename__)
+        kwargs['data-target'] = field.id + '-id'
+        kwargs['list'] = field.id + '-options'
+        kwargs['value'] = field.data.label() if field.data is not None else ''
+        return Markup('<input type="hidden" id="{0}-id" name="{1}" value="{2}">'
+            '<input {3}><datalist id="{0}-options"></datalist>'.format(
+                field.id, field.name, field._id if field._id is not None else '', widgets.html_params(**kwargs)))
+
+
+class AutocompleteField(CachedSelectField):
+    """
+    Relationship field for large tables: renders a type-ahead text box instead
+    of a <select> of every row and accepts the id it submits, so the page is
+    the same size however many rows the related table has.
+    """
+    widget = AutocompleteWidget()
+
+    def __init__(self, label=None, validators=None, model=None, allow_blank=False, **kwargs):
+        super(AutocompleteField, self).__init__(label, validators, model=model, allow_blank=allow_blank, **kwargs)
+
+    def process_formdata(self, valuelist):
+        if valuelist and valuelist[0] == '':
+            valuelist = ['__None']
+        super(AutocompleteField, self).process_formdata(valuelist)
+
+    def pre_validate(self, form):
+        if self._id is None:
+            if not self.allow_blank:
+                raise ValidationError(self.gettext('Not a valid choice'))
+        elif self.data is None:
+            raise ValidationError(self.gettext('Not a valid choice'))
 
 
 class EmptyForm(FlaskForm):
@@ -58,10 +168,10 @@ class AuthorForm(FlaskForm):
 
 
 class BookForm(FlaskForm):
-    universe = QuerySelectField('Universe', query_factory=universe_choices, get_label='title', allow_blank=True)
-    series = QuerySelectField('Series', query_factory=series_choices, get_label='title', allow_blank=True)
-    author = QuerySelectField('Author', query_factory=author_choices, get_label='full_name', allow_blank=True)
-    coauthor = QuerySelectField('Co-Author', query_factory=author_choices, get_label='full_name', allow_blank=True)
+    universe = CachedSelectField('Universe', model=Universe, choices=universe_choices, allow_blank=True)
+    series = AutocompleteField('Series', model=Series, allow_blank=True)
+    author = AutocompleteField('Author', model=Author, allow_blank=True)
+    coauthor = AutocompleteField('Co-Author', model=Author, allow_blank=True)
     title = StringField('Title', validators=[DataRequired()])
     series_number = IntegerField('Series Number', validators=[Optional()])
     submit = SubmitField('Submit')
@@ -69,19 +179,19 @@ class BookForm(FlaskForm):
 
 
 class CharacterForm(FlaskForm):
-    universe = QuerySelectField('Universe', query_factory=universe_choices, get_label='title', allow_blank=True)
-    series = QuerySelectField('Series', validators=[DataRequired()], query_factory=series_choices, get_label='title', allow_blank=True)
+    universe = CachedSelectField('Universe', model=Universe, choices=universe_choices, allow_blank=True)
+    series = AutocompleteField('Series', validators=[DataRequired()], model=Series, allow_blank=True)
     first_name = StringField('First Name', validators=[DataRequired()])
     last_name = StringField('Last Name')
     suffix = StringField('Suffix', filters=[lambda x: x or None])
-    parent = QuerySelectField('Parent', query_factory=character_choices, get_label='full_name', allow_blank=True)
+    parent = AutocompleteField('Parent', model=Character, allow_blank=True)
     description = TextAreaField('Description', filters=[lambda x: x or None])
     submit = SubmitField('Submit')
     delete = SubmitField('Delete')
 
 
 class SeriesForm(FlaskForm):
-    universe = QuerySelectField('Universe', query_factory=universe_choices, get_label='title', allow_blank=True)
+    universe = CachedSelectField('Universe', model=Universe, choices=universe_choices, allow_blank=True)
     title = StringField('Title', validators=[DataRequired()])
     submit = SubmitField('Submit')
     delete = SubmitField('Delete')
@@ -1,13 +1,22 @@
-from flask import current_app, render_template, flash, redirect, url_for, request, jsonify, send_from_directory
+from flask import current_app, render_template, flash, redirect, url_for, request, jsonify, send_from_directory, abort, \
+    Response, stream_with_context, make_response, session, Markup, has_request_context
 from flask_login import current_user, login_required
 from werkzeug.urls import url_parse
-from werkzeug.utils import secure_filename
 from app import db, s3
+from app.cache import commit_hooks, fragment_cache, user_cache
+from app.uploads import uploads, presigned_download
 from app.main.forms import EmptyForm, ActorForm, ArtForm, AuthorForm, BookForm, CharacterForm, SeriesForm, UniverseForm, UploadForm
-from app.models import User, Actor, Art, Author, Book, Character, Series, Universe
+from app.models import User, Actor, Art, Author, Book, Character, Series, Universe, Reference, TableVersion, TagBase, Upload, \
+    autocomplete_columns
 from app.main import bp
-from sqlalchemy import exc
+from app.exporter import export_records, formats
+from app.pagination import keyset_paginate
+from sqlalchemy import exc, func
+from functools import wraps
+import hashlib
 import os
+import sys
+import time
 
 
 @bp.route('/')
@@ -34,7 +43,18 @@ def favicon():
 
 @bp.route('/search')
 def search():
-    return render_template('search.html')
+    read_from_replica()
+    expression = request.args.get('q', '').strip()
+    limit = current_app.config['SEARCH_RESULTS']
+    hits = []
+    if expression:
+        for ResourceClass, endpoint in detail_endpoints.items():
+            hits.extend((score, ResourceClass.__name__, obj, endpoint) for obj, score in ResourceClass.search(expression, limit))
+        hits.sort(key=lambda hit: hit[0])
+
+    results = [{'type': type_name, 'label': obj.label(), 'url': url_for(endpoint, id=obj.id)}
+        for score, type_name, obj, endpoint in hits[:limit]]
+    return render_template('search.html', title='Search', query=expression, results=results)
 
 
 @bp.route('/explore')
@@ -47,6 +67,47 @@ def submit():
     return render_template('submit.html')
 
 
+@bp.route('/api/metrics')
+@login_required
+def metrics():
+    return jsonify({'user_cache': user_cache.stats()})
+
+
+def prefix_upper_bound(prefix):
+    """Return the smallest string above every string starting with `prefix`, or None if there is none"""
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    # skip the surrogate range, which can't be encoded to bind
+    next_char = '\ue000' if prefix[-1] == '\ud7ff' else chr(ord(prefix[-1]) + 1)
+    return prefix[:-1] + next_char
+
+
+@bp.route('/api/autocomplete/<model>')
+def autocomplete(model):
+    ResourceClass = autocomplete_models.get(model)
+    if ResourceClass is None:
+        abort(404)
+
+    prefix = request.args.get('q', '').strip().lower()
+    limit = min(max(request.args.get('limit', current_app.config['AUTOCOMPLETE_RESULTS'], type=int), 1),
+        current_app.config['MAX_AUTOCOMPLETE_RESULTS'])
+    if not prefix:
+        return jsonify(results=[])
+
+    # One index range scan per name column, each capped at `limit`, then merged
+    upper = prefix_upper_bound(prefix)
+    matches = {}
+    for name in autocomplete_columns[ResourceClass]:
+        column = func.lower(getattr(ResourceClass, name))
+        bounds = [column >= prefix] if upper is None else [column >= prefix, column < upper]
+        for resource in ResourceClass.query.filter(*bounds).order_by(column).limit(limit):
+            matches[resource.id] = resource.label()
+
+    results = sorted(matches.items(), key=lambda match: match[1].lower())[:limit]
+    return jsonify(results=[{'id': id, 'label': label} for id, label in results])
+
+
 # Actor Endpoints
 
 @bp.route('/actors/add', methods=['GET', 'POST'])
@@ -67,6 +128,10 @@ def get_actor(id):
     columns = ['first_name', 'middle_name', 'last_name', 'suffix']
     return get_resource(Actor, id, 'resource.html', url_for('main.get_actors'), 'main.get_actor', 'main.edit_actor', columns)
 
+@bp.route('/actors/export')
+def export_actors():
+    return export_resources(Actor)
+
 @bp.route('/actors/<int:id>', methods=['DELETE'])
 def delete_actor(id):
     return delete_resource(Actor, id)
@@ -92,6 +157,10 @@ def get_art_id(id):
     columns = ['artist', 'title', 'description', 'source']
     return get_resource(Art, id, 'resource.html', url_for('main.get_art'), 'main.get_art_id', 'main.edit_art', columns)
 
+@bp.route('/art/export')
+def export_art():
+    return export_resources(Art)
+
 @bp.route('/art/<int:id>', methods=['DELETE'])
 def delete_art(id):
     return delete_resource(Art, id)
@@ -109,7 +178,7 @@ def edit_author(id):
 
 @bp.route('/authors')
 def get_authors():
-    columns = ['first_name', 'middle_name', 'last_name', 'suffix']
+    columns = ['first_name', 'middle_name', 'last_name', 'suffix', 'book_count']
     return get_resources(Author, 'resource.html', url_for('main.explore'), 'main.get_author', 'main.edit_author', columns)
 
 @bp.route('/authors/<int:id>')
@@ -117,6 +186,10 @@ def get_author(id):
     columns = ['first_name', 'middle_name', 'last_name', 'suffix']
     return get_resource(Author, id, 'resource.html', url_for('main.get_authors'), 'main.get_author', 'main.edit_author', columns)
 
+@bp.route('/authors/export')
+def export_authors():
+    return export_resources(Author)
+
 @bp.route('/authors/<int:id>', methods=['DELETE'])
 def delete_author(id):
     return delete_resource(Author, id)
@@ -142,6 +215,10 @@ def get_book(id):
     columns = ['universe', 'series', 'author', 'title', 'series_number']
     return get_resource(Book, id, 'resource.html', url_for('main.get_books'), 'main.get_book', 'main.edit_book', columns)
 
+@bp.route('/books/export')
+def export_books():
+    return export_resources(Book)
+
 @bp.route('/books/<int:id>', methods=['DELETE'])
 def delete_book(id):
     return delete_resource(Book, id)
@@ -159,7 +236,7 @@ def edit_character(id):
 
 @bp.route('/characters')
 def get_characters():
-    columns = ['universe', 'series', 'first_name', 'last_name', 'suffix', 'description']
+    columns = ['universe', 'series', 'first_name', 'last_name', 'suffix', 'description', 'appearance_count']
     return get_resources(Character, 'resource.html', url_for('main.explore'), 'main.get_character', 'main.edit_character', columns)
 
 @bp.route('/characters/<int:id>')
@@ -167,6 +244,10 @@ def get_character(id):
     columns = ['universe', 'series', 'first_name', 'last_name', 'suffix', 'description']
     return get_resource(Character, id, 'resource.html', url_for('main.get_characters'), 'main.get_character', 'main.edit_character', columns)
 
+@bp.route('/characters/export')
+def export_characters():
+    return export_resources(Character)
+
 @bp.route('/characters/<int:id>', methods=['DELETE'])
 def delete_character(id):
     return delete_resource(Character, id)
@@ -184,7 +265,7 @@ def edit_series(id):
 
 @bp.route('/series')
 def get_series():
-    columns = ['universe', 'title']
+    columns = ['universe', 'title', 'book_count']
     return get_resources(Series, 'resource.html', url_for('main.explore'), 'main.get_series_id', 'main.edit_series', columns)
 
 @bp.route('/series/<int:id>')
@@ -192,6 +273,10 @@ def get_series_id(id):
     columns = ['universe', 'title']
     return get_resource(Series, id, 'resource.html', url_for('main.get_series'), 'main.get_series_id', 'main.edit_series', columns)
 
+@bp.route('/series/export')
+def export_series():
+    return export_resources(Series)
+
 @bp.route('/series/<int:id>', methods=['DELETE'])
 def delete_series(id):
     return delete_resource(Series, id)
@@ -209,7 +294,7 @@ def edit_universe(id):
 
 @bp.route('/universes')
 def get_universes():
-    columns = ['title']
+    columns = ['title', 'book_count']
     return get_resources(Universe, 'resource.html', url_for('main.explore'), 'main.get_universe', 'main.edit_universe', columns)
 
 @bp.route('/universes/<int:id>')
@@ -217,11 +302,30 @@ def get_universe(id):
     columns = ['title']
     return get_resource(Universe, id, 'resource.html', url_for('main.get_universes'), 'main.get_universe', 'main.edit_universe', columns)
 
+@bp.route('/universes/export')
+def export_universes():
+    return export_resources(Universe)
+
 @bp.route('/universes/<int:id>', methods=['DELETE'])
 def delete_universe(id):
     return delete_resource(Universe, id)
 
 
+# Models exposed through /api/autocomplete/<model>
+autocomplete_models = {model.__tablename__: model for model in autocomplete_columns}
+
+# Detail page endpoint for each searchable resource
+detail_endpoints = {
+    Actor: 'main.get_actor',
+    Art: 'main.get_art_id',
+    Author: 'main.get_author',
+    Book: 'main.get_book',
+    Character: 'main.get_character',
+    Series: 'main.get_series_id',
+    Universe: 'main.get_universe',
+}
+
+
 # CRUD functions for basic resource management
 
 def add_resource(ResourceClass, FormClass, default_template, redirect_url, back_url):
@@ -270,21 +374,171 @@ def edit_resource(ResourceClass, FormClass, id, default_template, redirect_url,
     return render_template(default_template, title='Edit Resource', form=form, back_url=back_url)
 
 def get_resources(ResourceClass, default_template, back_url, get_uri, edit_uri, columns):
-    resources = ResourceClass.query.all()
-    return render_template(default_template, results=resources, back_url=back_url, get_uri=get_uri, edit_uri=edit_uri, columns=columns)
+    read_from_replica()
+    tables = ResourceClass.tables_for(columns)
+    faceted = issubclass(ResourceClass, TagBase)
+    if faceted:
+        tables |= ResourceClass.tag_tables()
+
+    def render_table():
+        per_page = min(max(request.args.get('per_page', current_app.config['RESOURCES_PER_PAGE'], type=int), 1),
+            current_app.config['MAX_RESOURCES_PER_PAGE'])
+        sort = request.args.get('sort')
+        direction = request.args.get('dir', 'asc')
+        if (sort is not None and sort not in columns) or direction not in ('asc', 'desc'):
+            abort(400)
+        try:
+            order, keys = ResourceClass.sort_order(sort, direction == 'desc')
+        except ValueError:
+            abort(400)
+
+        query = ResourceClass.query.options(*ResourceClass.loader_options(columns))
+
+        facets = None
+        if faceted:
+            whereclause, facets = tag_facets(ResourceClass)
+            if whereclause is not None:
+                query = query.filter(whereclause)
+
+        try:
+            page = keyset_paginate(query, order, keys, per_page, after=request.args.get('after'),
+                before=request.args.get('before'))
+        except ValueError:
+            abort(400)
+
+        next_url = page_url(after=page.next_cursor) if page.has_next else None
+        prev_url = page_url(before=page.prev_cursor) if page.has_prev else None
+        return render_template('_resource_table.html', results=page.items, get_uri=get_uri, edit_uri=edit_uri, columns=columns,
+            next_url=next_url, prev_url=prev_url, facets=facets, sort=sort, direction=direction,
+            sort_urls={name: sort_url(name, 'desc' if sort == name and direction == 'asc' else 'asc') for name in columns})
+
+    def render(version):
+        table = fragment_cache.get_or_render(tables, (request.endpoint, request.full_path, version), render_table)
+        return render_template(default_template, table=Markup(table), back_url=back_url)
+
+    return conditional_response(tables, render)
 
 def get_resource(ResourceClass, id, default_template, back_url, get_uri, edit_uri, columns):
-    resource = ResourceClass.query.get(id)
+    read_from_replica()
 
-    if resource:
-        return render_template(default_template, results=[resource], back_url=back_url, get_uri=get_uri, edit_uri=edit_uri, columns=columns)
-    else:        
-        return render_template('errors/404.html'), 404
-    
+    def render(version):
+        resource = ResourceClass.query.options(*ResourceClass.loader_options(columns)).get(id)
+
+        if resource:
+            return render_template(default_template, results=[resource], back_url=back_url, get_uri=get_uri, edit_uri=edit_uri, columns=columns)
+        else:
+            return render_template('errors/404.html'), 404
+
+    return conditional_response(ResourceClass.tables_for(columns), render)
+
+def conditional_response(tables, render):
+    """
+    Answer a GET from the version counters of the tables a page reads: if the
+    client's ETag is still current, return 304 without querying the models
+    or rendering the template. Otherwise `render` is called with the version
+    tag so it can key cached fragments on it. No Last-Modified is sent: its
+    one-second granularity would let a write in the same second go unseen.
+    """
+    version = TableVersion.current(tables)
+
+    # Pending flash messages are rendered into the page, so it can't be reused
+    if session.get('_flashes'):
+        return render(version)
+
+    etag = hashlib.sha1('{}|{}|{}'.format(request.full_path, version, current_user.get_id()).encode('utf-8')).hexdigest()
+    fresh = request.if_none_match.contains(etag)
+
+    response = current_app.response_class(status=304) if fresh else make_response(render(version))
+    if response.status_code in (200, 304):
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+    return response
+
+def export_resources(ResourceClass):
+    read_from_replica()
+    format = request.args.get('format', 'csv')
+    if format not in formats:
+        abort(400)
+
+    render, mimetype = formats[format]
+    filename = '{}.{}'.format(ResourceClass.__tablename__, format)
+    return Response(stream_with_context(render(ResourceClass, export_records(ResourceClass))), mimetype=mimetype,
+        headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+def read_from_replica():
+    """
+    Send the rest of this request's queries to the read replica, unless this
+    client committed a write within the last REPLICA_LAG_WINDOW seconds and
+    might not see it there yet. The flag is cleared when the request ends,
+    after any streamed response has been generated.
+    """
+    if time.time() - session.get('last_write', 0) >= current_app.config['REPLICA_LAG_WINDOW']:
+        db.session.info['replica'] = True
+
+@bp.teardown_app_request
+def read_from_primary(exception=None):
+    db.session.info.pop('replica', None)
+
+def remember_write(tables):
+    if has_request_context():
+        session['last_write'] = time.time()
+
+commit_hooks.append(remember_write)
+
+def tag_facets(ResourceClass):
+    """
+    Read the ?tag=<id>&match=all|any filter of a tagged resource list and
+    return (WHERE clause or None, facets for the template). Facet counts are
+    taken over the filtered rows, and each tag links to the list with that
+    tag toggled.
+    """
+    tag_ids = set(request.args.getlist('tag', type=int))
+    match = request.args.get('match', 'all')
+    if match not in ('all', 'any'):
+        abort(400)
+
+    whereclause = ResourceClass.tag_filter(tag_ids, match) if tag_ids else None
+    groups = [(type_name, [(tag, count, tag.id in tag_ids, facet_url(tag_ids ^ {tag.id}, match)) for tag, count in tags])
+        for type_name, tags in ResourceClass.tag_facets(whereclause)]
+    return whereclause, {'groups': groups, 'match': match, 'selected': tag_ids, 'clear_url': facet_url(set(), match),
+        'match_urls': {option: facet_url(tag_ids, option) for option in ('all', 'any')}}
+
+def facet_url(tag_ids, match):
+    """Rebuild the current list URL with a new tag filter, starting again from the first page"""
+    args = request.args.to_dict(flat=False)
+    for name in ('after', 'before', 'tag', 'match'):
+        args.pop(name, None)
+    if tag_ids:
+        args['tag'] = sorted(tag_ids)
+    if match != 'all':
+        args['match'] = match
+    return url_for(request.endpoint, **args)
+
+def sort_url(sort, direction):
+    """Rebuild the current list URL sorted by another column, starting again from the first page"""
+    args = request.args.to_dict(flat=False)
+    for name in ('after', 'before', 'sort', 'dir'):
+        args.pop(name, None)
+    args['sort'] = sort
+    if direction != 'asc':
+        args['dir'] = direction
+    return url_for(request.endpoint, **args)
+
+def page_url(**cursor):
+    """Rebuild the current list URL with a new page cursor, keeping the other query args"""
+    args = request.args.to_dict(flat=False)
+    args.pop('after', None)
+    args.pop('before', None)
+    args.update(cursor)
+    return url_for(request.endpoint, **args)
 
 def delete_resource(ResourceClass, id):
     try:
-        result = ResourceClass.query.filter_by(id=id).delete()
+        # Delete through the session so flush listeners (e.g. the search index) see the row go
+        result = ResourceClass.query.get(id)
+        if result:
+            db.session.delete(result)
         db.session.commit()
 
         if result:
@@ -301,39 +555,68 @@ def delete_resource(ResourceClass, id):
 
 # CRUD functions for S3
 
+def s3_required(view):
+    """Answer 503 from views that need S3 when no bucket is configured"""
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if not s3.configured:
+            abort(503)
+        return view(*args, **kwargs)
+    return decorated
+
 @bp.route('/upload', methods=['GET', 'POST'])
+@s3_required
+@login_required
 def upload_file():
     form = UploadForm()
     
     if form.validate_on_submit():
-        filename = secure_filename(form.file.data.filename)
-        print("ATTEMPTING FILE UPLOAD")
-        output = send_to_s3(form.file.data)
-        flash(output)
-        print("ATTEMPTING FILE DELETE")
-        deleteput = delete_from_s3('Reyna.png')
-        print(deleteput)
+        upload = uploads.submit(form.file.data, current_user)
+        flash('Uploading {}; check {} for progress'.format(upload.filename, url_for('main.upload_status', id=upload.id)))
         return redirect(url_for('main.upload_file'))
 
     return render_template('upload.html', form=form)
 
-def send_to_s3(file):
-    """
-    Docs: http://boto3.readthedocs.io/en/latest/guide/s3.html
-    """
-    try:
-        s3.upload_fileobj(
-            file,
-            current_app.config["S3_BUCKET"],
-            file.filename,
-            ExtraArgs={
-                "ContentType": file.content_type
-            }
-        )
-    except Exception as e:
-        print("Something Happened: ", e)
-        return e
-    return "{}{}".format(current_app.config["S3_LOCATION"], file.filename)
+def own_upload_or_404(id):
+    upload = Upload.query.get_or_404(id)
+    if upload.user_id != current_user.id:
+        abort(404)
+    return upload
+
+@bp.route('/uploads/<int:id>')
+@login_required
+def upload_status(id):
+    return jsonify(own_upload_or_404(id).to_dict())
+
+@bp.route('/api/uploads', methods=['POST'])
+@login_required
+@s3_required
+def presign_upload():
+    data = request.get_json(silent=True) or {}
+    if not data.get('filename') or not data.get('content_type'):
+        abort(400)
+
+    upload, presigned = uploads.presign(data['filename'], data['content_type'], current_user)
+    return jsonify(upload=upload.to_dict(), request=presigned, complete_url=url_for('main.complete_upload', id=upload.id)), 201
+
+@bp.route('/api/uploads/<int:id>/complete', methods=['POST'])
+@login_required
+@s3_required
+def complete_upload(id):
+    upload = own_upload_or_404(id)
+    if not uploads.complete(upload):
+        if upload.status == 'failed':
+            return jsonify(error='The upload was rejected: ' + upload.error, upload=upload.to_dict()), 413
+        return jsonify(error='The object has not been uploaded', upload=upload.to_dict()), 409
+    return jsonify(upload=upload.to_dict())
+
+@bp.route('/references/<int:id>/download')
+@s3_required
+def download_reference(id):
+    reference = Reference.query.get_or_404(id)
+    if reference.private and not current_user.is_authenticated:
+        abort(404)
+    return redirect(presigned_download(reference, request.args.get('width', type=int)))
 
 def delete_from_s3(key):
     try:
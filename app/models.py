@@ -1,18 +1,173 @@
 from flask import current_app
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.orm import class_mapper, ColumnProperty
+import hashlib
+import importlib
+from collections import defaultdict
+from datetime import datetime
+from itertools import chain, groupby
+from functools import reduce
+from sqlalchemy import inspect, select, tuple_, bindparam, func, or_
+from sqlalchemy.orm import class_mapper, ColumnProperty, joinedload, selectinload, make_transient_to_detached
 from sqlalchemy.ext.hybrid import hybrid_property
 from app import db, login
+from app.cache import mark_changed, change_hooks, user_cache
+from app.search import add_to_index, remove_from_index, rebuild_index, query_index, create_index, drop_index
 
 class BaseModel(db.Model):
     __abstract__ = True
 
+    # Stable sort key for list pages; the primary key is appended as a tie-breaker
+    __sort_key__ = ()
+
     def columns(self):
         """Return the actual columns of a SQLAlchemy-mapped object"""
         return [prop.key for prop in class_mapper(self.__class__).iterate_properties
             if isinstance(prop, ColumnProperty)]
-    
+
+    def label(self):
+        """Return the human-readable name a resource is listed by"""
+        if hasattr(self, 'full_name'):
+            return self.full_name
+        return getattr(self, 'title', None) or str(self)
+
+    @classmethod
+    def sort_columns(cls):
+        """Return the column names list pages are ordered by, ending with the primary key"""
+        return list(cls.__sort_key__) + ['id']
+
+    @classmethod
+    def sort_order(cls, name=None, descending=False):
+        """Return (order, keys) for a list page sorted by column or many-to-one relationship `name`
+
+        `order` is the keyset order as (column, descending) pairs: the sort
+        column, then this model's sort key and primary key as tie-breakers, all
+        in one direction so a single index serves both. A relationship sorts
+        by its `<name>_sort` column, this table's copy of the related row's
+        sort key (see SortKeyColumn), so no join is needed. `keys` reads a
+        row's sort key values. Raises ValueError for anything else.
+        """
+        own = cls.sort_columns()
+        relationship = class_mapper(cls).relationships.get(name) if name else None
+        if relationship is not None:
+            if relationship.uselist or name + '_sort' not in class_mapper(cls).columns:
+                raise ValueError('Cannot sort by {}'.format(name))
+            name += '_sort'
+        elif name and name not in class_mapper(cls).columns:
+            raise ValueError('Cannot sort by {}'.format(name))
+
+        lead = [name] if name else []
+        own = [key for key in own if key not in lead]
+        order = [(getattr(cls, key), descending) for key in lead + own]
+        keys = lambda row: [getattr(row, key) for key in lead + own]
+        return order, keys
+
+    @classmethod
+    def sort_index(cls, name):
+        """Return the column names of the index that serves sorting by `name` (see sort_order)"""
+        lead = [name + '_sort' if name in class_mapper(cls).relationships else name]
+        return lead + [key for key in cls.__sort_key__ if key not in lead]
+
+    @classmethod
+    def tables_for(cls, columns):
+        """Return the names of the tables a page listing `columns` of this model reads"""
+        relationships = class_mapper(cls).relationships
+        tables = {cls.__tablename__}
+        for name in columns:
+            if name in relationships:
+                tables.add(relationships[name].mapper.local_table.name)
+        return tables
+
+    @classmethod
+    def loader_options(cls, columns):
+        """Return eager-load options for the relationships named in a route's column list"""
+        relationships = class_mapper(cls).relationships
+        options = []
+        for name in columns:
+            relationship = relationships.get(name)
+            if relationship is None or relationship.lazy == 'dynamic':
+                continue
+            loader = selectinload if relationship.uselist else joinedload
+            options.append(loader(getattr(cls, name)))
+        return options
+
+
+def full_name(first_name, middle_name, last_name, suffix):
+    """Actor/Author full_name computed from plain column values, for queries that skip the ORM"""
+    first = first_name + ' ' + middle_name if middle_name else first_name
+    last = last_name + ' ' + suffix if suffix else last_name
+    return first + ' ' + last
+
+
+class SearchableMixin(object):
+    @classmethod
+    def search(cls, expression, limit):
+        """Return up to `limit` (object, score) pairs matching `expression`, best match first"""
+        hits = query_index(db.session.connection(), cls.__tablename__, cls.__searchable__, expression, limit)
+        if not hits:
+            return []
+        objects = {obj.id: obj for obj in cls.query.filter(cls.id.in_([id for id, score in hits]))}
+        return [(objects[id], score) for id, score in hits if id in objects]
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        for obj in session.new:
+            if isinstance(obj, SearchableMixin):
+                add_to_index(session.connection(), obj.__tablename__, obj)
+        for obj in session.dirty:
+            if isinstance(obj, SearchableMixin) and obj.search_fields_changed():
+                add_to_index(session.connection(), obj.__tablename__, obj)
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                remove_from_index(session.connection(), obj.__tablename__, obj)
+
+    @classmethod
+    def reindex(cls, whereclause=None):
+        rebuild_index(db.session.connection(), cls.__tablename__, cls.__searchable__, whereclause)
+
+    @classmethod
+    def after_create(cls, target, connection, **kw):
+        create_index(connection, cls.__tablename__, cls.__searchable__)
+
+    @classmethod
+    def before_drop(cls, target, connection, **kw):
+        drop_index(connection, cls.__tablename__)
+
+    def search_fields_changed(self):
+        attrs = inspect(self).attrs
+        return any(attrs[field].history.has_changes() for field in self.__searchable__)
+
+
+# Per-table version counters, bumped in the same transaction as every write
+
+class TableVersion(BaseModel):
+    name = db.Column(db.Text, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @staticmethod
+    def bump(session, tables):
+        table = TableVersion.__table__
+        connection = session.connection()
+        now = datetime.utcnow()
+        for name in sorted(tables):
+            result = connection.execute(table.update().where(table.c.name == name)
+                .values(version=table.c.version + 1, updated_at=now))
+            if not result.rowcount:
+                connection.execute(table.insert().values(name=name, version=1, updated_at=now))
+
+    @staticmethod
+    def current(tables):
+        """Return a version tag covering `tables`, using one Core query"""
+        table = TableVersion.__table__
+        rows = db.session.execute(select(table.c.name, table.c.version)
+            .where(table.c.name.in_(sorted(tables))).order_by(table.c.name)).fetchall()
+        return hashlib.sha1(repr([tuple(row) for row in rows]).encode('utf-8')).hexdigest()
+
+
+change_hooks.append(TableVersion.bump)
+
+
 # User model for logins
 
 class User(UserMixin, BaseModel):
@@ -30,46 +185,69 @@ class User(UserMixin, BaseModel):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+def user_values(id):
+    row = db.session.query(*User.__table__.columns).filter(User.id == id).first()
+    return row._asdict() if row else None
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    values = user_cache.get(int(id), user_values)
+    if values is None:
+        return None
+    user = User(**values)
+    make_transient_to_detached(user)
+    return user
 
 
 # Tag association tables
 
 actor_tags = db.Table('actor_tags',
     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
-    db.Column('actor_id', db.Integer, db.ForeignKey('actor.id'))
+    db.Column('actor_id', db.Integer, db.ForeignKey('actor.id')),
+    db.PrimaryKeyConstraint('actor_id', 'tag_id'),
+    db.Index('ix_actor_tags_tag_id', 'tag_id', 'actor_id')
 )
 
 art_tags = db.Table('art_tags',
     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
-    db.Column('art_id', db.Integer, db.ForeignKey('art.id'))
+    db.Column('art_id', db.Integer, db.ForeignKey('art.id')),
+    db.PrimaryKeyConstraint('art_id', 'tag_id'),
+    db.Index('ix_art_tags_tag_id', 'tag_id', 'art_id')
 )
 
 book_tags = db.Table('book_tags',
     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
-    db.Column('book_id', db.Integer, db.ForeignKey('book.id'))
+    db.Column('book_id', db.Integer, db.ForeignKey('book.id')),
+    db.PrimaryKeyConstraint('book_id', 'tag_id'),
+    db.Index('ix_book_tags_tag_id', 'tag_id', 'book_id')
 )
 
 character_tags = db.Table('character_tags',
     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
-    db.Column('character_id', db.Integer, db.ForeignKey('character.id'))
+    db.Column('character_id', db.Integer, db.ForeignKey('character.id')),
+    db.PrimaryKeyConstraint('character_id', 'tag_id'),
+    db.Index('ix_character_tags_tag_id', 'tag_id', 'character_id')
 )
 
 series_tags = db.Table('series_tags',
     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
-    db.Column('series_id', db.Integer, db.ForeignKey('series.id'))
+    db.Column('series_id', db.Integer, db.ForeignKey('series.id')),
+    db.PrimaryKeyConstraint('series_id', 'tag_id'),
+    db.Index('ix_series_tags_tag_id', 'tag_id', 'series_id')
 )
 
 universe_tags = db.Table('universe_tags',
     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
-    db.Column('universe_id', db.Integer, db.ForeignKey('universe.id'))
+    db.Column('universe_id', db.Integer, db.ForeignKey('universe.id')),
+    db.PrimaryKeyConstraint('universe_id', 'tag_id'),
+    db.Index('ix_universe_tags_tag_id', 'tag_id', 'universe_id')
 )
 
 reference_tags = db.Table('reference_tags',
     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
-    db.Column('reference_id', db.Integer, db.ForeignKey('reference.id'))
+    db.Column('reference_id', db.Integer, db.ForeignKey('reference.id')),
+    db.PrimaryKeyConstraint('reference_id', 'tag_id'),
+    db.Index('ix_reference_tags_tag_id', 'tag_id', 'reference_id')
 )
 
 
@@ -77,17 +255,23 @@ reference_tags = db.Table('reference_tags',
 
 actor_refs = db.Table('actor_refs',
     db.Column('reference_id', db.Integer, db.ForeignKey('reference.id')),
-    db.Column('actor_id', db.Integer, db.ForeignKey('actor.id'))
+    db.Column('actor_id', db.Integer, db.ForeignKey('actor.id')),
+    db.PrimaryKeyConstraint('actor_id', 'reference_id'),
+    db.Index('ix_actor_refs_reference_id', 'reference_id', 'actor_id')
 )
 
 art_refs = db.Table('art_refs',
     db.Column('reference_id', db.Integer, db.ForeignKey('reference.id')),
-    db.Column('art_id', db.Integer, db.ForeignKey('art.id'))
+    db.Column('art_id', db.Integer, db.ForeignKey('art.id')),
+    db.PrimaryKeyConstraint('art_id', 'reference_id'),
+    db.Index('ix_art_refs_reference_id', 'reference_id', 'art_id')
 )
 
 character_refs = db.Table('character_refs',
     db.Column('reference_id', db.Integer, db.ForeignKey('reference.id')),
-    db.Column('character_id', db.Integer, db.ForeignKey('character.id'))
+    db.Column('character_id', db.Integer, db.ForeignKey('character.id')),
+    db.PrimaryKeyConstraint('character_id', 'reference_id'),
+    db.Index('ix_character_refs_reference_id', 'reference_id', 'character_id')
 )
 
 # Should be able to add this to allow cover art on character pages?
@@ -101,12 +285,86 @@ character_refs = db.Table('character_refs',
 
 appearances = db.Table('appearances',
     db.Column('book_id', db.Integer, db.ForeignKey('book.id')),
-    db.Column('character_id', db.Integer, db.ForeignKey('character.id'))
+    db.Column('character_id', db.Integer, db.ForeignKey('character.id')),
+    db.PrimaryKeyConstraint('character_id', 'book_id'),
+    db.Index('ix_appearances_book_id', 'book_id', 'character_id')
 )
 
 
+# Association tables are keyed owner-first (e.g. actor_id, tag_id) for membership
+# checks, with a reverse index (tag_id, actor_id) for lookups like "all books with tag X"
+
 # Association parent classes/functions
 
+# Pairs per membership query, kept well under SQLite's bound parameter limit
+LINK_BATCH_SIZE = 400
+
+def link_many(pairs, relationship, unlink=False):
+    """Add (or remove) many (object, target) pairs of a many-to-many relationship
+
+    Pairs are grouped by association table and resolved with one set-based
+    membership query per batch, followed by a single executemany insert or
+    delete of just the rows that need to change. Returns the number of rows
+    changed.
+    """
+    pairs = list(pairs)
+    for obj in set(x for pair in pairs for x in pair):
+        if inspect(obj).transient:
+            db.session.add(obj)
+    db.session.flush()
+
+    # Read primary keys from the identity map so expired objects aren't refreshed one by one
+    groups = defaultdict(dict)
+    for obj, target in pairs:
+        key = (inspect(obj).identity[0], inspect(target).identity[0])
+        groups[type(obj)][key] = target
+
+    changed = 0
+    related = defaultdict(set)
+    for cls, targets in groups.items():
+        changed_before = changed
+        prop = getattr(cls, relationship).property
+        association = prop.secondary
+        local = prop.synchronize_pairs[0][1]
+        remote = prop.secondary_synchronize_pairs[0][1]
+        keys = list(targets)
+
+        for start in range(0, len(keys), LINK_BATCH_SIZE):
+            batch = keys[start:start + LINK_BATCH_SIZE]
+            existing = set(tuple(row) for row in db.session.execute(
+                select(local, remote).where(tuple_(local, remote).in_(batch))))
+
+            pending = [(l, r) for l, r in batch if ((l, r) in existing) == unlink]
+            if unlink:
+                rows = [{'_local': l, '_remote': r} for l, r in pending]
+                statement = association.delete().where(
+                    local == bindparam('_local')).where(remote == bindparam('_remote'))
+            else:
+                rows = [{local.key: l, remote.key: r} for l, r in pending]
+                statement = association.insert()
+
+            if rows:
+                db.session.execute(statement, rows)
+                changed += len(rows)
+                source = related_sources.get(association.name)
+                if source:
+                    related[source[0]].update(l if local.name == source[1] else r for l, r in pending)
+
+        if changed > changed_before:
+            mark_changed(db.session, association.name)
+
+        # The targets' backref lists (e.g. Tag.books) no longer match the table
+        backref = prop.backref[0] if isinstance(prop.backref, tuple) else prop.backref
+        if backref:
+            for target in set(targets.values()):
+                db.session.expire(target, [backref])
+
+    for kind, ids in related.items():
+        mark_related(db.session, kind, ids)
+        related_counters[kind].recount(db.session, ids)
+    return changed
+
+
 class TagBase(object):
     def add_tag(self, tag):
         if not self.is_tagged(tag):
@@ -117,8 +375,54 @@ class TagBase(object):
             self.tags.remove(tag)
 
     def is_tagged(self, tag, association):
-        return self.tags.filter(
-            association.c.tag_id == tag.id).count() > 0
+        return db.session.query(self.tags.filter(
+            association.c.tag_id == tag.id).exists()).scalar()
+
+    @classmethod
+    def tag_association(cls):
+        """Return the association table behind `tags` and its column holding this class's ids"""
+        prop = cls.tags.property
+        return prop.secondary, prop.synchronize_pairs[0][1]
+
+    @classmethod
+    def tag_tables(cls):
+        return {cls.tag_association()[0].name, Tag.__tablename__, TagType.__tablename__}
+
+    @classmethod
+    def tag_filter(cls, tag_ids, match='all'):
+        """Return a WHERE clause for resources tagged with all (or any) of `tag_ids`"""
+        association, owner = cls.tag_association()
+        tagged = select(owner).where(association.c.tag_id.in_(tag_ids))
+        if match == 'all':
+            tagged = tagged.group_by(owner).having(func.count() == len(set(tag_ids)))
+        return cls.id.in_(tagged)
+
+    @classmethod
+    def tag_facets(cls, whereclause=None):
+        """
+        Count the resources carrying each tag, among those matching
+        `whereclause` if given, with one grouped query. Returns
+        [(tag type name, [(tag, count), ...]), ...], most used tags first.
+        """
+        association, owner = cls.tag_association()
+        count = func.count(owner)
+        query = db.session.query(Tag, TagType.name, count).join(association, association.c.tag_id == Tag.id) \
+            .outerjoin(TagType, Tag.tag_type_id == TagType.id)
+        if whereclause is not None:
+            query = query.filter(owner.in_(select(cls.id).where(whereclause)))
+        rows = query.group_by(Tag.id).order_by(TagType.name, count.desc(), Tag.name, Tag.id).all()
+        return [(type_name, [(tag, count) for tag, name, count in group])
+            for type_name, group in groupby(rows, key=lambda row: row[1])]
+
+    @staticmethod
+    def tag_many(pairs):
+        """Tag many (object, tag) pairs at once, skipping existing tags"""
+        return link_many(pairs, 'tags')
+
+    @staticmethod
+    def untag_many(pairs):
+        """Untag many (object, tag) pairs at once, skipping missing tags"""
+        return link_many(pairs, 'tags', unlink=True)
 
 
 class RefBase(object):
@@ -131,8 +435,18 @@ class RefBase(object):
             self.refs.remove(ref)
 
     def is_referenced(self, ref, association):
-        return self.refs.filter(
-            association.c.reference_id == ref.id).count() > 0
+        return db.session.query(self.refs.filter(
+            association.c.reference_id == ref.id).exists()).scalar()
+
+    @staticmethod
+    def ref_many(pairs):
+        """Reference many (object, reference) pairs at once, skipping existing references"""
+        return link_many(pairs, 'refs')
+
+    @staticmethod
+    def unref_many(pairs):
+        """Remove many (object, reference) pairs at once, skipping missing references"""
+        return link_many(pairs, 'refs', unlink=True)
 
 
 # Association models
@@ -142,10 +456,18 @@ class Tag(BaseModel):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text)
     tag_type_id = db.Column(db.Integer, db.ForeignKey('tag_type.id'))
+    usage_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    tag_type = db.relationship('TagType', backref='tags')
 
     def __repr__(self):
         return '{}'.format(self.name)
 
+    def related(self, limit=None):
+        """Return (tag, shared object count) pairs from the precomputed related_tag table"""
+        query = db.session.query(Tag, RelatedTag.count).join(RelatedTag, RelatedTag.related_id == Tag.id) \
+            .filter(RelatedTag.tag_id == self.id).order_by(RelatedTag.count.desc(), Tag.id)
+        return query.limit(limit).all() if limit else query.all()
+
 
 class TagType(BaseModel):
     id = db.Column(db.Integer, primary_key=True)
@@ -156,13 +478,149 @@ class Reference(BaseModel):
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.Text)
     private = db.Column(db.Boolean, default=False)
+    sha256 = db.Column(db.Text, unique=True)
+    derivatives = db.relationship('ReferenceDerivative', backref='reference', lazy='selectin',
+        cascade='all, delete-orphan', order_by='[ReferenceDerivative.size, ReferenceDerivative.id]')
+
+    def best_derivative(self, width, format=None):
+        """Return the smallest derivative at least `width` pixels wide, or None if the original is needed"""
+        for derivative in self.derivatives:
+            if (format is None or derivative.format == format) and derivative.width >= width:
+                return derivative
+        return None
+
+
+class ReferenceDerivative(BaseModel):
+    __table_args__ = (db.UniqueConstraint('reference_id', 'size', 'format'),)
+    id = db.Column(db.Integer, primary_key=True)
+    reference_id = db.Column(db.Integer, db.ForeignKey('reference.id'), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    format = db.Column(db.Text, nullable=False)
+    key = db.Column(db.Text, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+
+
+class Upload(BaseModel):
+    """A reference image spooled to local disk and waiting for, or done with, its S3 transfer"""
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.Text, nullable=False)
+    content_type = db.Column(db.Text)
+    key = db.Column(db.Text, nullable=False)
+    sha256 = db.Column(db.Text)
+    path = db.Column(db.Text)
+    status = db.Column(db.Text, nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    reference_id = db.Column(db.Integer, db.ForeignKey('reference.id'))
+    reference = db.relationship('Reference')
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+
+    def to_dict(self):
+        return {'id': self.id, 'filename': self.filename, 'key': self.key, 'status': self.status,
+            'attempts': self.attempts, 'error': self.error, 'reference_id': self.reference_id}
+
+
+# Precomputed related items
+#
+# related_character and related_tag hold the top co-occurring neighbors of
+# each character (by shared book appearances) and tag (by shared tagged
+# objects), built by app.related. Every change to the association tables they
+# are computed from records the affected characters or tags in related_dirty,
+# in the same transaction, so a refresh only has to recompute those rows.
+
+class RelatedCharacter(BaseModel):
+    character_id = db.Column(db.Integer, db.ForeignKey('character.id', ondelete='CASCADE'), primary_key=True)
+    related_id = db.Column(db.Integer, db.ForeignKey('character.id', ondelete='CASCADE'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+
+class RelatedTag(BaseModel):
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    related_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+
+class RelatedDirty(BaseModel):
+    kind = db.Column(db.Text, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True)
+
+
+# Association table name -> (kind, column holding the item whose neighbors it feeds)
+related_sources = {appearances.name: ('character', 'character_id')}
+related_sources.update((table.name, ('tag', 'tag_id')) for table in
+    (actor_tags, art_tags, book_tags, character_tags, series_tags, universe_tags, reference_tags))
+
+
+def mark_related(session, kind, ids):
+    """Record that the neighbors of the `kind` items `ids` need recomputing"""
+    ids = set(ids) - {None}
+    if not ids:
+        return
+
+    table = RelatedDirty.__table__
+    connection = session.connection()
+    dialect = connection.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        # the dialect package is already loaded by the engine, so this import is free
+        insert = importlib.import_module('sqlalchemy.dialects.' + dialect).insert
+        connection.execute(insert(table).on_conflict_do_nothing(), [{'kind': kind, 'id': id} for id in sorted(ids)])
+        return
+
+    ids = sorted(ids)
+    for start in range(0, len(ids), LINK_BATCH_SIZE):
+        batch = ids[start:start + LINK_BATCH_SIZE]
+        marked = set(id for id, in connection.execute(select(table.c.id)
+            .where(table.c.kind == kind).where(table.c.id.in_(batch))))
+        if set(batch) - marked:
+            connection.execute(table.insert(), [{'kind': kind, 'id': id} for id in batch if id not in marked])
+
+
+def related_changes(session, objects, deleted=False):
+    """Return {kind: ids} for the items whose co-occurrences change with `objects`' collections"""
+    changes = defaultdict(set)
+    for obj in objects:
+        state = inspect(obj)
+        for relationship in state.mapper.relationships:
+            source = relationship.secondary is not None and related_sources.get(relationship.secondary.name)
+            if not source:
+                continue
+            kind, column = source
+            local = relationship.synchronize_pairs[0][1]
+            if local.name == column:
+                if deleted or state.attrs[relationship.key].history.has_changes():
+                    changes[kind].add(obj.id)
+            elif deleted:
+                # the association rows are about to go; read whose neighbors they fed
+                changes[kind].update(id for id, in session.connection().execute(
+                    select(relationship.secondary.c[column]).where(local == obj.id)))
+            else:
+                history = state.attrs[relationship.key].history
+                changes[kind].update(item.id for item in chain(history.added, history.deleted))
+    return changes
+
+
+def track_related_deletes(session, flush_context, instances):
+    for kind, ids in related_changes(session, session.deleted, deleted=True).items():
+        mark_related(session, kind, ids)
+        count_later(session, related_counters[kind], ids)
+
+
+def track_related(session, flush_context):
+    for kind, ids in related_changes(session, chain(session.new, session.dirty)).items():
+        mark_related(session, kind, ids)
+        count_later(session, related_counters[kind], ids)
 
 
 # Main object models
 
-class Actor(BaseModel, TagBase, RefBase):
+class Actor(BaseModel, SearchableMixin, TagBase, RefBase):
     # Table definitions
-    __table_args__ = (db.UniqueConstraint('first_name', 'last_name'),)
+    __table_args__ = (db.UniqueConstraint('first_name', 'last_name'),
+        db.Index('ix_actor_last_name_first_name', 'last_name', 'first_name'))
+    __sort_key__ = ('last_name', 'first_name')
+    __searchable__ = ['first_name', 'middle_name', 'last_name', 'suffix']
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.Text, nullable=False, default='')
     middle_name = db.Column(db.Text)
@@ -193,9 +651,11 @@ class Actor(BaseModel, TagBase, RefBase):
         return super().is_referenced(ref, actor_refs)
 
 
-class Art(BaseModel, TagBase, RefBase):
+class Art(BaseModel, SearchableMixin, TagBase, RefBase):
     # Table definitions
     __table_args__ = (db.UniqueConstraint('title', 'source'),)
+    __sort_key__ = ('title', 'source')
+    __searchable__ = ['title', 'description', 'artist']
     id = db.Column(db.Integer, primary_key=True)
     artist = db.Column(db.Text)
     title = db.Column(db.Text)
@@ -219,14 +679,18 @@ class Art(BaseModel, TagBase, RefBase):
         return super().is_referenced(ref, art_refs)
 
 
-class Author(BaseModel):
+class Author(BaseModel, SearchableMixin):
     # Table definitions
-    __table_args__ = (db.UniqueConstraint('first_name', 'last_name'),)
+    __table_args__ = (db.UniqueConstraint('first_name', 'last_name'),
+        db.Index('ix_author_last_name_first_name', 'last_name', 'first_name'))
+    __sort_key__ = ('last_name', 'first_name')
+    __searchable__ = ['first_name', 'middle_name', 'last_name', 'suffix']
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.Text, nullable=False, default='')
     middle_name = db.Column(db.Text)
     last_name = db.Column(db.Text, nullable=False, default='')
     suffix = db.Column(db.Text)
+    book_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # Property for select field labels
     @hybrid_property
@@ -240,15 +704,20 @@ class Author(BaseModel):
         return '{}'.format(self.full_name)
 
 
-class Book(BaseModel, TagBase):
+class Book(BaseModel, SearchableMixin, TagBase):
     # Table definitions
+    __sort_key__ = ('title',)
+    __searchable__ = ['title']
     id = db.Column(db.Integer, primary_key=True)
     universe_id = db.Column(db.Integer, db.ForeignKey('universe.id'))
     series_id = db.Column(db.Integer, db.ForeignKey('series.id'))
     author_id = db.Column(db.Integer, db.ForeignKey('author.id'))
-    coauthor_id = db.Column(db.Integer, db.ForeignKey('author.id'))
+    coauthor_id = db.Column(db.Integer, db.ForeignKey('author.id'), index=True)
     title = db.Column(db.Text, unique=True)
     series_number = db.Column(db.Integer)
+    universe_sort = db.Column(db.Text, info={'sort_key': True})
+    series_sort = db.Column(db.Text, info={'sort_key': True})
+    author_sort = db.Column(db.Text, info={'sort_key': True})
 
     # Table associations
     tags = db.relationship('Tag', secondary=book_tags, lazy='dynamic',
@@ -276,21 +745,27 @@ class Book(BaseModel, TagBase):
             self.characters.remove(character)
 
     def has_character_appearance(self, character):
-        return self.characters.filter(
-            appearances.c.character_id == character.id).count() > 0
+        return db.session.query(self.characters.filter(
+            appearances.c.character_id == character.id).exists()).scalar()
 
 
-class Character(BaseModel, TagBase, RefBase):
+class Character(BaseModel, SearchableMixin, TagBase, RefBase):
     # Table definitions
-    __table_args__ = (db.UniqueConstraint('series_id', 'first_name', 'last_name'),)
+    __table_args__ = (db.UniqueConstraint('series_id', 'first_name', 'last_name'),
+        db.Index('ix_character_last_name_first_name', 'last_name', 'first_name'))
+    __sort_key__ = ('last_name', 'first_name')
+    __searchable__ = ['first_name', 'last_name', 'suffix', 'description']
     id = db.Column(db.Integer, primary_key=True)
     universe_id = db.Column(db.Integer, db.ForeignKey('universe.id'))
     series_id = db.Column(db.Integer, db.ForeignKey('series.id'), nullable=False, default=0)
-    parent_id = db.Column(db.Integer, db.ForeignKey('character.id'))
+    parent_id = db.Column(db.Integer, db.ForeignKey('character.id'), index=True)
     first_name = db.Column(db.Text, nullable=False, default='')
     last_name = db.Column(db.Text, nullable=False, default='')
     suffix = db.Column(db.Text)
     description = db.Column(db.Text)
+    appearance_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    universe_sort = db.Column(db.Text, info={'sort_key': True})
+    series_sort = db.Column(db.Text, info={'sort_key': True})
 
     # Table associations
     tags = db.relationship('Tag', secondary=character_tags, lazy='dynamic',
@@ -328,15 +803,71 @@ class Character(BaseModel, TagBase, RefBase):
             self.books.remove(book)
 
     def has_book_appearance(self, book):
-        return self.books.filter(
-            appearances.c.book_id == book.id).count() > 0
-
-
-class Series(BaseModel, TagBase):
+        return db.session.query(self.books.filter(
+            appearances.c.book_id == book.id).exists()).scalar()
+
+    # Alias graph traversal, each a single query however deep the alias tree is
+    @staticmethod
+    def alias_group(id):
+        """
+        Return a recursive CTE of the ids of every character in the same alias
+        tree as `id`: its ancestors through parent_id, and everything below
+        them. UNION drops rows already seen, so a parent cycle still ends.
+        """
+        table = Character.__table__
+        parent, child = table.alias(), table.alias()
+        ancestors = select(table.c.id, table.c.parent_id).where(table.c.id == id) \
+            .cte('alias_ancestors', recursive=True)
+        ancestors = ancestors.union(select(parent.c.id, parent.c.parent_id)
+            .join(ancestors, parent.c.id == ancestors.c.parent_id))
+        group = select(ancestors.c.id).cte('alias_group', recursive=True)
+        return group.union(select(child.c.id).join(group, child.c.parent_id == group.c.id))
+
+    def all_aliases(self):
+        """Return every other character in this character's alias tree"""
+        group = Character.alias_group(self.id)
+        return Character.query.filter(Character.id.in_(select(group.c.id)), Character.id != self.id) \
+            .order_by(Character.last_name, Character.first_name, Character.id).all()
+
+    def all_appearances(self):
+        """Return the books this character or any of its aliases appears in"""
+        group = Character.alias_group(self.id)
+        books = select(appearances.c.book_id).where(appearances.c.character_id.in_(select(group.c.id)))
+        return Book.query.filter(Book.id.in_(books)).order_by(Book.title, Book.id).all()
+
+    def co_appearing(self, limit=None):
+        """
+        Return (character, shared book count) pairs for characters outside
+        this alias tree that appear in a book with any alias, most shared first
+        """
+        group = select(Character.alias_group(self.id).c.id)
+        mine, theirs = appearances.alias(), appearances.alias()
+        shared = func.count(func.distinct(theirs.c.book_id))
+        query = db.session.query(Character, shared) \
+            .join(theirs, theirs.c.character_id == Character.id) \
+            .join(mine, mine.c.book_id == theirs.c.book_id) \
+            .filter(mine.c.character_id.in_(group), Character.id.notin_(group)) \
+            .group_by(Character.id) \
+            .order_by(shared.desc(), Character.last_name, Character.first_name, Character.id)
+        return query.limit(limit).all() if limit else query.all()
+
+    def related(self, limit=None):
+        """Return (character, shared book count) pairs from the precomputed related_character table"""
+        query = db.session.query(Character, RelatedCharacter.count) \
+            .join(RelatedCharacter, RelatedCharacter.related_id == Character.id) \
+            .filter(RelatedCharacter.character_id == self.id).order_by(RelatedCharacter.count.desc(), Character.id)
+        return query.limit(limit).all() if limit else query.all()
+
+
+class Series(BaseModel, SearchableMixin, TagBase):
     # Table definitions
+    __sort_key__ = ('title',)
+    __searchable__ = ['title']
     id = db.Column(db.Integer, primary_key=True)
     universe_id = db.Column(db.Integer, db.ForeignKey('universe.id'))
     title = db.Column(db.Text, unique=True)
+    book_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    universe_sort = db.Column(db.Text, info={'sort_key': True})
 
     # Table associations
     tags = db.relationship('Tag', secondary=series_tags, lazy='dynamic',
@@ -351,10 +882,13 @@ class Series(BaseModel, TagBase):
         return super().is_tagged(tag, series_tags)
 
 
-class Universe(BaseModel, TagBase):
+class Universe(BaseModel, SearchableMixin, TagBase):
     # Table definitions
+    __sort_key__ = ('title',)
+    __searchable__ = ['title']
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.Text, unique=True)
+    book_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # Table associations
     tags = db.relationship('Tag', secondary=universe_tags, lazy='dynamic',
@@ -366,3 +900,231 @@ class Universe(BaseModel, TagBase):
 
     def is_tagged(self, tag):
         return super().is_tagged(tag, universe_tags)
+
+
+# Denormalized relationship counts
+#
+# Series/Universe/Author.book_count, Character.appearance_count and
+# Tag.usage_count are kept in step with the rows they count. Flushes, link_many
+# and the importer collect the ids whose counts may have moved and recount just
+# those rows with one correlated UPDATE in the same transaction, which stays
+# exact where +1/-1 bookkeeping would drift. `flask library recount` rebuilds
+# every row.
+
+class CounterColumn(object):
+    """`model`.`name` counts the rows of each (table, foreign key columns) source that point at it"""
+    def __init__(self, model, name, sources):
+        self.model = model
+        self.name = name
+        self.sources = sources
+
+    def expression(self):
+        id = self.model.__table__.c.id
+        return reduce(lambda a, b: a + b, [select(func.count()).select_from(table)
+            .where(or_(*(column == id for column in columns))).scalar_subquery() for table, columns in self.sources])
+
+    def recount(self, session, ids=None):
+        """Recompute the count for `ids`, or for every row"""
+        table = self.model.__table__
+        statement = table.update().values({self.name: self.expression()})
+        if ids is None:
+            session.connection().execute(statement)
+        else:
+            ids = sorted(set(ids) - {None})
+            if not ids:
+                return
+            for start in range(0, len(ids), LINK_BATCH_SIZE):
+                session.connection().execute(statement.where(table.c.id.in_(ids[start:start + LINK_BATCH_SIZE])))
+        mark_changed(session, table.name)
+
+
+book = Book.__table__
+book_counters = [
+    CounterColumn(Series, 'book_count', [(book, [book.c.series_id])]),
+    CounterColumn(Universe, 'book_count', [(book, [book.c.universe_id])]),
+    CounterColumn(Author, 'book_count', [(book, [book.c.author_id, book.c.coauthor_id])]),
+]
+# Keyed like related_sources, whose changes they count
+related_counters = {
+    'character': CounterColumn(Character, 'appearance_count', [(appearances, [appearances.c.character_id])]),
+    'tag': CounterColumn(Tag, 'usage_count', [(table, [table.c.tag_id]) for table in
+        (actor_tags, art_tags, book_tags, character_tags, series_tags, universe_tags, reference_tags)]),
+}
+counters = book_counters + list(related_counters.values())
+
+
+def count_later(session, counter, ids):
+    session.info.setdefault('recount', {}).setdefault(counter, set()).update(ids)
+
+
+def recount_rows(session, table, rows):
+    """Recount the counters fed by `table` for the ids referenced by `rows` (dicts keyed by column)"""
+    for counter in counters:
+        for source, columns in counter.sources:
+            if source is table:
+                counter.recount(session, [row.get(column.key) for row in rows for column in columns])
+
+
+def track_book_counts_before(session, flush_context, instances):
+    # the stored foreign keys of changed and deleted books, before the flush moves them
+    ids = [inspect(obj).identity[0] for obj in chain(session.dirty, session.deleted)
+        if isinstance(obj, Book) and inspect(obj).identity]
+    for start in range(0, len(ids), LINK_BATCH_SIZE):
+        rows = session.connection().execute(select(book).where(book.c.id.in_(ids[start:start + LINK_BATCH_SIZE])))
+        rows = [row._asdict() for row in rows]
+        for counter in book_counters:
+            count_later(session, counter, [row[column.key] for row in rows for column in counter.sources[0][1]])
+
+
+def track_book_counts(session, flush_context):
+    books = [obj for obj in chain(session.new, session.dirty) if isinstance(obj, Book)]
+    for counter in book_counters:
+        count_later(session, counter, [getattr(obj, column.key) for obj in books for column in counter.sources[0][1]])
+
+
+def recount_changed(session, flush_context):
+    for counter, ids in session.info.pop('recount', {}).items():
+        counter.recount(session, ids)
+
+
+# Denormalized sort keys
+#
+# List pages sorted by a many-to-one relationship order by the related row's
+# sort key. Ordering by the joined table's columns can't use an index on this
+# one, so each such relationship has a `<name>_sort` column holding a copy of
+# the related row's sort key (multi-column keys joined with a unit separator,
+# which sorts below any printable character). Like the counters above, flushes
+# and the importer refresh just the rows whose copies may have moved with one
+# correlated UPDATE, and `flask library recount` rebuilds them all.
+
+class SortKeyColumn(object):
+    """`model`.`name`_sort copies the sort key of the row relationship `name` points at"""
+    def __init__(self, model, name):
+        self.model = model
+        self.name = name
+        relationship = class_mapper(model).relationships[name]
+        self.foreign_key = next(iter(relationship.local_columns))
+        self.target = relationship.mapper.class_
+        self.column = model.__table__.c[name + '_sort']
+
+    def expression(self):
+        target = self.target.__table__
+        keys = [target.c[key] for key in self.target.__sort_key__]
+        if len(keys) > 1:
+            keys = [func.coalesce(key, '') for key in keys]
+        value = reduce(lambda a, b: a + '\x1f' + b, keys)
+        return select(value).where(target.c.id == self.foreign_key).scalar_subquery()
+
+    def refresh(self, session, ids=None, related_ids=None):
+        """Recopy the sort key for the rows `ids`, the rows pointing at `related_ids`, or every row"""
+        table = self.model.__table__
+        statement = table.update().values({self.column.key: self.expression()})
+        if ids is None and related_ids is None:
+            session.connection().execute(statement)
+        for column, values in ((table.c.id, ids), (self.foreign_key, related_ids)):
+            values = sorted(set(values or ()) - {None})
+            for start in range(0, len(values), LINK_BATCH_SIZE):
+                session.connection().execute(statement.where(column.in_(values[start:start + LINK_BATCH_SIZE])))
+        mark_changed(session, table.name)
+
+
+sort_keys = [
+    SortKeyColumn(Book, 'universe'),
+    SortKeyColumn(Book, 'series'),
+    SortKeyColumn(Book, 'author'),
+    SortKeyColumn(Character, 'universe'),
+    SortKeyColumn(Character, 'series'),
+    SortKeyColumn(Series, 'universe'),
+]
+
+
+def refresh_sort_keys(session, model, whereclause):
+    """Recopy every sort key of the `model` rows matching `whereclause`, e.g. rows inserted with Core"""
+    ids = [id for id, in session.connection().execute(select(model.__table__.c.id).where(whereclause))]
+    for sort_key in sort_keys:
+        if sort_key.model is model:
+            sort_key.refresh(session, ids=ids)
+
+
+def track_sort_keys_before(session, flush_context, instances):
+    # rows pointing at deleted rows, found before the flush clears their foreign keys
+    for sort_key in sort_keys:
+        ids = [inspect(obj).identity[0] for obj in session.deleted
+            if isinstance(obj, sort_key.target) and inspect(obj).identity]
+        table = sort_key.model.__table__
+        for start in range(0, len(ids), LINK_BATCH_SIZE):
+            owners = session.connection().execute(select(table.c.id)
+                .where(sort_key.foreign_key.in_(ids[start:start + LINK_BATCH_SIZE])))
+            session.info.setdefault('sort_keys', {}).setdefault(sort_key, set()).update(id for id, in owners)
+
+
+def track_sort_keys(session, flush_context):
+    pending = session.info.pop('sort_keys', {})
+    for sort_key in sort_keys:
+        ids = pending.get(sort_key, set())
+        ids.update(obj.id for obj in session.new if isinstance(obj, sort_key.model))
+        ids.update(obj.id for obj in session.dirty if isinstance(obj, sort_key.model) and
+            any(inspect(obj).attrs[key].history.has_changes() for key in (sort_key.name, sort_key.foreign_key.key)))
+        related_ids = [obj.id for obj in session.dirty if isinstance(obj, sort_key.target) and
+            any(inspect(obj).attrs[key].history.has_changes() for key in sort_key.target.__sort_key__)]
+        if ids or related_ids:
+            sort_key.refresh(session, ids, related_ids)
+
+
+# Case-insensitive prefix indexes for autocomplete lookups
+autocomplete_columns = {
+    Actor: ['first_name', 'last_name'],
+    Author: ['first_name', 'last_name'],
+    Book: ['title'],
+    Character: ['first_name', 'last_name'],
+    Series: ['title'],
+    Universe: ['title'],
+}
+for model, names in autocomplete_columns.items():
+    for name in names:
+        db.Index('ix_{}_lower_{}'.format(model.__tablename__, name), db.func.lower(getattr(model, name)))
+
+
+# Indexes for the orders list pages can be sorted in; rowid is the implicit last column
+sortable_columns = {
+    Actor: ['first_name', 'middle_name', 'last_name', 'suffix'],
+    Art: ['artist', 'title', 'description', 'source'],
+    Author: ['first_name', 'middle_name', 'last_name', 'suffix', 'book_count'],
+    Book: ['universe', 'series', 'author', 'title', 'series_number'],
+    Character: ['universe', 'series', 'first_name', 'last_name', 'suffix', 'description', 'appearance_count'],
+    Series: ['universe', 'title', 'book_count'],
+    Universe: ['title', 'book_count'],
+}
+
+def indexed_columns(table):
+    """Return the column name lists of a table's plain (not expression) indexes and unique constraints"""
+    indexes = [index.expressions for index in table.indexes]
+    indexes += [constraint.columns for constraint in table.constraints if isinstance(constraint, db.UniqueConstraint)]
+    indexes += [[column] for column in table.columns if column.unique]
+    return [[column.name for column in columns] for columns in indexes
+        if all(isinstance(column, db.Column) for column in columns)]
+
+def index_unless_covered(model, columns):
+    if not any(existing[:len(columns)] == columns for existing in indexed_columns(model.__table__)):
+        db.Index('ix_{}_{}'.format(model.__tablename__, '_'.join(columns)), *[getattr(model, c) for c in columns])
+
+for model, names in sortable_columns.items():
+    for name in names:
+        index_unless_covered(model, model.sort_index(name))
+
+# The foreign keys sort keys are copied through, for refreshing and recounting a related row's rows
+for sort_key in sort_keys:
+    index_unless_covered(sort_key.model, [sort_key.foreign_key.key] + list(sort_key.model.__sort_key__))
+
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
+db.event.listen(db.session, 'before_flush', track_related_deletes)
+db.event.listen(db.session, 'after_flush', track_related)
+db.event.listen(db.session, 'before_flush', track_book_counts_before)
+db.event.listen(db.session, 'after_flush', track_book_counts)
+db.event.listen(db.session, 'after_flush', recount_changed)
+db.event.listen(db.session, 'before_flush', track_sort_keys_before)
+db.event.listen(db.session, 'after_flush', track_sort_keys)
+for model in (Actor, Art, Author, Book, Character, Series, Universe):
+    db.event.listen(model.__table__, 'after_create', model.after_create)
+    db.event.listen(model.__table__, 'before_drop', model.before_drop)
@@ -0,0 +1,111 @@
+import base64
+import binascii
+import json
+from sqlalchemy import and_, or_, false
+
+
+# Keyset (seek) pagination
+#
+# Instead of OFFSET, each page remembers the sort key values of its first and
+# last rows and the next query seeks past them, so every page costs the same
+# index range scan no matter how deep into the table it is. NULLs are treated
+# as the lowest value (SQLite's ordering), so they come first ascending and
+# last descending.
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """Decode a cursor string, raising ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid page cursor')
+
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError('Invalid page cursor')
+    # only scalars can be bound against the sort columns
+    if not all(value is None or isinstance(value, (str, int, float)) for value in values):
+        raise ValueError('Invalid page cursor')
+    return values
+
+
+def _is_equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def _is_after(column, value, descending):
+    if descending:
+        return false() if value is None else or_(column < value, column.is_(None))
+    return column.isnot(None) if value is None else column > value
+
+
+def seek_after(order, values):
+    """Build a WHERE clause matching the rows that sort after `values`
+
+    `order` is a list of (column, descending) pairs whose last entry must be
+    unique and non-null (normally the primary key) so the ordering is total.
+    """
+    clauses = []
+    for i, (column, descending) in enumerate(order):
+        equal = [_is_equal(c, v) for (c, _), v in zip(order[:i], values[:i])]
+        clauses.append(and_(*equal, _is_after(column, values[i], descending)))
+
+    clause = or_(*clauses)
+
+    # Give the planner a plain range on the leading column to seek with
+    column, descending = order[0]
+    if values[0] is not None and not descending:
+        clause = and_(column >= values[0], clause)
+    return clause
+
+
+def _order_by(order):
+    return [column.desc() if descending else column.asc() for column, descending in order]
+
+
+class KeysetPage(object):
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, order, keys, per_page, after=None, before=None):
+    """Return one KeysetPage of `query` sorted by `order`
+
+    `keys` extracts the sort key values (in `order` order) from a result row.
+    `after`/`before` are cursors from a previous page; at most one is used.
+    """
+    if before is not None:
+        values = decode_cursor(before, len(order))
+        reverse = [(column, not descending) for column, descending in order]
+        rows = query.filter(seek_after(reverse, values)) \
+            .order_by(*_order_by(reverse)).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        return KeysetPage(items,
+            next_cursor=encode_cursor(keys(items[-1])) if items else before,
+            prev_cursor=encode_cursor(keys(items[0])) if items and has_more else None)
+
+    if after is not None:
+        values = decode_cursor(after, len(order))
+        query = query.filter(seek_after(order, values))
+
+    rows = query.order_by(*_order_by(order)).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+    return KeysetPage(items,
+        next_cursor=encode_cursor(keys(items[-1])) if items and has_more else None,
+        prev_cursor=(encode_cursor(keys(items[0])) if items else after) if after is not None else None)
@@ -0,0 +1,176 @@
+import heapq
+from collections import Counter, defaultdict
+from importlib.util import find_spec
+from flask import current_app
+from sqlalchemy import literal, select, union_all
+from app import db
+from app.cache import mark_changed
+from app.models import appearances, actor_tags, art_tags, book_tags, character_tags, series_tags, universe_tags, \
+    reference_tags, RelatedCharacter, RelatedDirty, RelatedTag
+
+
+# Co-occurrence refresh
+#
+# Each kind of related item is an incidence matrix: rows are the items
+# (characters or tags), columns the things they are attached to (books, or
+# tagged objects of any type), loaded with one query. Multiplying it by its
+# transpose counts the columns every pair of rows shares; only the top
+# RELATED_TOP_K neighbors of each row are kept. NumPy/SciPy, pinned in
+# requirements.txt, do the sparse product; where they are missing the counts
+# are built in plain Python, much more slowly, and the refresh logs a warning.
+#
+# A refresh recomputes just the rows marked in related_dirty, plus the rows
+# whose counts those changes move: everything that now shares a column with
+# a dirty row, and everything that listed a dirty row as a neighbor before.
+# Only the pairs in columns those rows are in are read.
+
+# Rows per sparse product, bounding the size of the dense-ish intermediate
+PRODUCT_BATCH_SIZE = 1000
+
+# Ids per IN clause, kept well under SQLite's bound parameter limit
+ID_BATCH_SIZE = 400
+
+tag_tables = (actor_tags, art_tags, book_tags, character_tags, series_tags, universe_tags, reference_tags)
+
+
+def sparse_available():
+    return find_spec('numpy') is not None and find_spec('scipy') is not None
+
+
+def character_incidence(rows=None):
+    query = select(appearances.c.character_id, appearances.c.book_id)
+    if rows is not None:
+        books = select(appearances.c.book_id).where(appearances.c.character_id.in_(rows))
+        query = query.where(appearances.c.book_id.in_(books))
+    return query
+
+
+def tag_incidence(rows=None):
+    # objects of different types share ids, so the column is (table, id)
+    def select_pairs(i, table):
+        owner = next(c for c in table.c if c.name != 'tag_id')
+        query = select(table.c.tag_id, literal(i), owner)
+        if rows is not None:
+            query = query.where(owner.in_(select(owner).where(table.c.tag_id.in_(rows))))
+        return query
+    return union_all(*(select_pairs(i, table) for i, table in enumerate(tag_tables)))
+
+
+relations = {
+    'character': (RelatedCharacter.__table__, 'character_id', character_incidence),
+    'tag': (RelatedTag.__table__, 'tag_id', tag_incidence),
+}
+
+
+def load_pairs(incidence, rows=None):
+    """
+    Return (row id, column key) pairs from an incidence query: every pair, or
+    with `rows` just those in the columns any of them is in, which is all
+    that counting their neighbors needs
+    """
+    if rows is None:
+        return [(row[0], tuple(row[1:])) for row in db.session.execute(incidence())]
+    pairs = set()
+    for batch in batches(rows):
+        pairs.update((row[0], tuple(row[1:])) for row in db.session.execute(incidence(batch)))
+    return list(pairs)
+
+
+def python_cooccurrence(pairs, rows, top_k):
+    columns = defaultdict(list)
+    row_columns = defaultdict(list)
+    for row, column in pairs:
+        columns[column].append(row)
+        row_columns[row].append(column)
+
+    neighbors = {}
+    for row in rows:
+        counts = Counter(other for column in row_columns.get(row, ()) for other in columns[column] if other != row)
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0])) if top_k is None else \
+            heapq.nsmallest(top_k, counts.items(), key=lambda item: (-item[1], item[0]))
+        neighbors[row] = ranked
+    return neighbors
+
+
+def sparse_cooccurrence(pairs, rows, top_k):
+    import numpy as np
+    from scipy import sparse
+
+    row_ids = sorted(set(row for row, column in pairs))
+    row_index = {id: i for i, id in enumerate(row_ids)}
+    column_index = {}
+    for row, column in pairs:
+        column_index.setdefault(column, len(column_index))
+    matrix = sparse.csr_matrix((np.ones(len(pairs), dtype=np.int32),
+        ([row_index[row] for row, column in pairs], [column_index[column] for row, column in pairs])),
+        shape=(len(row_ids), len(column_index)))
+    ids = np.array(row_ids)
+    transpose = matrix.T.tocsc()
+
+    neighbors = {row: [] for row in rows}
+    wanted = [row for row in rows if row in row_index]
+    for start in range(0, len(wanted), PRODUCT_BATCH_SIZE):
+        batch = wanted[start:start + PRODUCT_BATCH_SIZE]
+        product = (matrix[[row_index[row] for row in batch]] @ transpose).tocsr()
+        for i, row in enumerate(batch):
+            others = ids[product.indices[product.indptr[i]:product.indptr[i + 1]]]
+            counts = product.data[product.indptr[i]:product.indptr[i + 1]]
+            keep = others != row
+            others, counts = others[keep], counts[keep]
+            order = np.lexsort((others, -counts))
+            if top_k is not None:
+                order = order[:top_k]
+            neighbors[row] = [(int(others[j]), int(counts[j])) for j in order]
+    return neighbors
+
+
+def cooccurrence(pairs, rows, top_k=None, sparse=None):
+    """Return {row: [(other row, shared column count), ...]} for `rows`, most shared first"""
+    if sparse is None:
+        sparse = sparse_available()
+    return (sparse_cooccurrence if sparse else python_cooccurrence)(pairs, rows, top_k)
+
+
+def batches(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), ID_BATCH_SIZE):
+        yield ids[start:start + ID_BATCH_SIZE]
+
+
+def refresh(kind, top_k, full=False, sparse=None):
+    """Recompute the stored neighbors of dirty `kind` rows (every row if `full`) and return how many were refreshed"""
+    table, key, incidence = relations[kind]
+    dirty_table = RelatedDirty.__table__
+    dirty = set(id for id, in db.session.execute(select(dirty_table.c.id).where(dirty_table.c.kind == kind)))
+    if not dirty and not full:
+        return 0
+    if sparse is None:
+        sparse = sparse_available()
+        if not sparse:
+            current_app.logger.warning('NumPy/SciPy are not installed; counting related {}s in Python'.format(kind))
+
+    if full:
+        pairs = load_pairs(incidence)
+        rows = set(row for row, column in pairs)
+        db.session.execute(table.delete())
+    else:
+        rows = set(dirty)
+        for neighbors in cooccurrence(load_pairs(incidence, dirty), dirty, sparse=sparse).values():
+            rows.update(other for other, count in neighbors)
+        for batch in batches(dirty):
+            rows.update(id for id, in db.session.execute(select(table.c[key]).where(table.c.related_id.in_(batch))))
+        for batch in batches(rows):
+            db.session.execute(table.delete().where(table.c[key].in_(batch)))
+        pairs = load_pairs(incidence, rows)
+
+    values = [{key: row, 'related_id': other, 'count': count}
+        for row, neighbors in cooccurrence(pairs, rows, top_k, sparse).items() for other, count in neighbors]
+    if values:
+        db.session.execute(table.insert(), values)
+
+    # only clear the marks that were read, so rows dirtied meanwhile wait for the next run
+    for batch in batches(dirty):
+        db.session.execute(dirty_table.delete().where(dirty_table.c.kind == kind).where(dirty_table.c.id.in_(batch)))
+    mark_changed(db.session, table.name)
+    db.session.commit()
+    return len(rows)
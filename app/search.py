@@ -0,0 +1,135 @@
+import re
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+
+# Full-text search index
+#
+# The app talks to whichever index object is installed as `app.search_index`
+# through the helpers at the bottom of this module, so another engine only has
+# to provide the same create/drop/add/remove/rebuild/query methods. The default
+# keeps one SQLite FTS5 table per searchable model in the main database, keyed by
+# the model's primary key, and is written on the session's own connection so
+# index updates commit or roll back together with the rows they describe.
+# Other databases get LikeSearch, which keeps no index and scans the model
+# table with LIKE instead.
+
+class FTS5Index(object):
+    tokenizer = 'unicode61 remove_diacritics 2'
+
+    def table(self, index):
+        return '{}_fts'.format(index)
+
+    def create(self, connection, index, fields):
+        connection.execute(text('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, tokenize="{}")'.format(
+            self.table(index), ', '.join(fields), self.tokenizer)))
+
+    def drop(self, connection, index):
+        connection.execute(text('DROP TABLE IF EXISTS {}'.format(self.table(index))))
+
+    def add(self, connection, index, id, values):
+        self.remove(connection, index, id)
+        connection.execute(text('INSERT INTO {} (rowid, {}) VALUES (:id, {})'.format(
+            self.table(index), ', '.join(values), ', '.join(':' + field for field in values))), dict(values, id=id))
+
+    def remove(self, connection, index, id):
+        connection.execute(text('DELETE FROM {} WHERE rowid = :id'.format(self.table(index))), {'id': id})
+
+    def rebuild(self, connection, index, fields, whereclause=None):
+        """Copy rows from the model table into the index, optionally limited by a SQL condition"""
+        where = ' WHERE {}'.format(whereclause) if whereclause else ''
+        if not whereclause:
+            connection.execute(text('DELETE FROM {}'.format(self.table(index))))
+        else:
+            connection.execute(text('DELETE FROM {} WHERE rowid IN (SELECT id FROM {}{})'.format(
+                self.table(index), index, where)))
+        connection.execute(text('INSERT INTO {} (rowid, {}) SELECT id, {} FROM {}{}'.format(
+            self.table(index), ', '.join(fields), ', '.join(fields), index, where)))
+
+    def query(self, connection, index, fields, expression, limit):
+        """Return up to `limit` (id, score) pairs, best match first"""
+        match = match_expression(expression)
+        if not match:
+            return []
+        result = connection.execute(text('SELECT rowid, bm25({0}) AS score FROM {0} WHERE {0} MATCH :match '
+            'ORDER BY score LIMIT :limit'.format(self.table(index))), {'match': match, 'limit': limit})
+        return [(row.rowid, row.score) for row in result]
+
+
+class LikeSearch(object):
+    """Unindexed fallback: every word must appear in one of the fields; all matches score the same"""
+    def create(self, connection, index, fields):
+        pass
+
+    def drop(self, connection, index):
+        pass
+
+    def add(self, connection, index, id, values):
+        pass
+
+    def remove(self, connection, index, id):
+        pass
+
+    def rebuild(self, connection, index, fields, whereclause=None):
+        pass
+
+    def query(self, connection, index, fields, expression, limit):
+        words = re.findall(r'\w+', expression or '', re.UNICODE)
+        if not words:
+            return []
+        params = {'limit': limit}
+        clauses = []
+        for i, word in enumerate(words):
+            params['word{}'.format(i)] = '%{}%'.format(re.sub(r'([\\%_])', r'\\\1', word.lower()))
+            clauses.append('({})'.format(' OR '.join("lower({}) LIKE :word{} ESCAPE '\\'".format(field, i)
+                for field in fields)))
+        result = connection.execute(text('SELECT id FROM {} WHERE {} ORDER BY id LIMIT :limit'.format(
+            index, ' AND '.join(clauses))), params)
+        return [(row.id, 0.0) for row in result]
+
+
+backends = {'fts5': FTS5Index, 'like': LikeSearch}
+
+
+def default_backend(database_uri):
+    """FTS5 on SQLite, LIKE scans anywhere else"""
+    return 'fts5' if make_url(database_uri).get_backend_name() == 'sqlite' else 'like'
+
+
+def match_expression(expression):
+    """Turn free text into an FTS5 query where every word is a required prefix"""
+    words = re.findall(r'\w+', expression or '', re.UNICODE)
+    return ' '.join('"{}"*'.format(word) for word in words)
+
+
+def create_index(connection, index, fields):
+    if current_app.search_index:
+        current_app.search_index.create(connection, index, fields)
+
+
+def drop_index(connection, index):
+    if current_app.search_index:
+        current_app.search_index.drop(connection, index)
+
+
+def add_to_index(connection, index, model):
+    if current_app.search_index:
+        values = {field: getattr(model, field) for field in model.__searchable__}
+        current_app.search_index.add(connection, index, model.id, values)
+
+
+def remove_from_index(connection, index, model):
+    if current_app.search_index:
+        current_app.search_index.remove(connection, index, model.id)
+
+
+def rebuild_index(connection, index, fields, whereclause=None):
+    if current_app.search_index:
+        current_app.search_index.rebuild(connection, index, fields, whereclause)
+
+
+def query_index(connection, index, fields, expression, limit):
+    if not current_app.search_index:
+        return []
+    return current_app.search_index.query(connection, index, fields, expression, limit)
@@ -0,0 +1,58 @@
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+
+# Startup profiling
+#
+# Cold start is measured in a fresh interpreter, since anything this process
+# has already imported would be free. `python -X importtime` reports every
+# import with its own and cumulative time in microseconds, indented by nesting
+# depth; import_profile parses that and package_totals rolls it up into the
+# per-package budget that `flask library importtime` prints.
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_STATEMENT = 'from app import create_app; create_app()'
+
+_line = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+
+def run_python(*args):
+    result = subprocess.run([sys.executable] + list(args), cwd=root, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return result
+
+
+def import_profile(statement=STARTUP_STATEMENT):
+    """Run `statement` under -X importtime and return (module, self us, cumulative us, depth) tuples"""
+    rows = []
+    for line in run_python('-X', 'importtime', '-c', statement).stderr.splitlines():
+        match = _line.match(line)
+        if match:
+            rows.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return rows
+
+
+def package_totals(rows):
+    """Sum the self time of every module by top-level package, slowest first"""
+    totals = defaultdict(int)
+    for module, self_us, cumulative_us, depth in rows:
+        totals[module.split('.')[0]] += self_us
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def cold_start(statement=STARTUP_STATEMENT, runs=3):
+    """Return the best wall-clock seconds, over `runs` fresh interpreters, to run `statement`"""
+    best = None
+    for i in range(runs):
+        start = time.perf_counter()
+        run_python('-c', statement)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
@@ -24,6 +24,32 @@ $(document).ready(function(){
         window.location = $(this).data("href");
     });
 
+    // Type-ahead relationship fields: fetch matches into the datalist and copy the chosen id into the hidden input
+    $("input[data-autocomplete]").each(function() {
+        var input = $(this);
+        var target = $('#' + input.data('target'));
+        var options = $('#' + input.attr('list'));
+        var timer = null;
+
+        input.on('input', function() {
+            var match = options.find('option').filter(function() { return this.value == input.val(); });
+            target.val(match.length ? match.data('id') : '');
+
+            clearTimeout(timer);
+            timer = setTimeout(function() {
+                if (!input.val() || match.length)
+                    return;
+
+                $.getJSON(input.data('autocomplete'), {q: input.val()}, function(data) {
+                    options.empty();
+                    $.each(data.results, function(i, result) {
+                        options.append($('<option>').attr('value', result.label).attr('data-id', result.id));
+                    });
+                });
+            }, 200);
+        });
+    });
+
     function deleteResource(url) {
         $.ajax({
             url: url,
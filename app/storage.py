@@ -0,0 +1,69 @@
+import threading
+
+
+class S3(object):
+    """
+    Flask extension holding one boto3 S3 client per app, created on first use
+    rather than at import time. boto3 clients are thread-safe, so the upload
+    workers and request threads all share it and its connection pool; the
+    pool size, retries and timeouts come from the app config. Attribute access
+    is forwarded to the client, so `s3.head_object(...)` works as before.
+    """
+    def __init__(self, app=None):
+        self._settings = None
+        self._client = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self._settings = {
+            'bucket': config['S3_BUCKET'],
+            'key': config['S3_KEY'],
+            'secret': config['S3_SECRET'],
+            'region': config['S3_REGION'],
+            'endpoint_url': config['S3_ENDPOINT_URL'],
+            'max_pool_connections': config['S3_MAX_POOL_CONNECTIONS'],
+            'max_attempts': config['S3_MAX_ATTEMPTS'],
+            'connect_timeout': config['S3_CONNECT_TIMEOUT'],
+            'read_timeout': config['S3_READ_TIMEOUT'],
+        }
+        with self._lock:
+            self._client = None
+        app.extensions['s3'] = self
+
+    @property
+    def configured(self):
+        """Whether a bucket is configured; without one the upload features are turned off"""
+        return bool(self._settings and self._settings['bucket'])
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    def _create_client(self):
+        if self._settings is None:
+            raise RuntimeError('S3 extension is not initialized')
+
+        import boto3
+        from botocore.config import Config
+
+        settings = self._settings
+        # a private session, since the default boto3 session is not thread-safe
+        session = boto3.session.Session()
+        return session.client('s3',
+            aws_access_key_id=settings['key'],
+            aws_secret_access_key=settings['secret'],
+            region_name=settings['region'],
+            endpoint_url=settings['endpoint_url'],
+            config=Config(max_pool_connections=settings['max_pool_connections'],
+                retries={'max_attempts': settings['max_attempts'], 'mode': 'standard'},
+                connect_timeout=settings['connect_timeout'], read_timeout=settings['read_timeout']))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -0,0 +1,53 @@
+import os
+from importlib.util import find_spec
+
+
+# Thumbnail derivatives
+#
+# Resizing runs in a separate process pool so large images don't hold the GIL
+# for the upload threads, which is why make_thumbnails takes and returns plain
+# values only. Pillow is in requirements.txt, but the app still runs without
+# it: references then simply have no derivatives (a warning is logged) and
+# pages fall back to the original.
+
+extensions = {'webp': 'webp', 'jpeg': 'jpg'}
+
+
+def available():
+    return find_spec('PIL') is not None
+
+
+def supported(content_type):
+    return (content_type or '').startswith('image/') and available()
+
+
+def derivative_key(key, size, format):
+    """Return the deterministic key of a derivative, stored next to the original"""
+    return '{}_{}.{}'.format(os.path.splitext(key)[0], size, extensions[format])
+
+
+def make_thumbnails(path, sizes, formats, quality):
+    """
+    Write a thumbnail of the image at `path` for every size (longest side in
+    pixels) and format, next to `path`. Returns (size, format, path, width,
+    height) tuples; sizes at or above the original's are skipped.
+    """
+    from PIL import Image
+
+    results = []
+    with Image.open(path) as original:
+        original.load()
+        image = original.convert('RGBA' if original.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+    for size in sorted(sizes):
+        if size >= max(image.size):
+            break
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size))
+        for format in formats:
+            output = '{}_{}.{}'.format(path, size, extensions[format])
+            # JPEG has no alpha channel
+            (thumbnail.convert('RGB') if format == 'jpeg' else thumbnail).save(
+                output, format.upper(), quality=quality)
+            results.append((size, format, output) + thumbnail.size)
+    return results
@@ -0,0 +1,388 @@
+import glob
+import hashlib
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from sqlalchemy import exc
+from flask import current_app
+from werkzeug.utils import secure_filename
+from app import db, s3
+from app import thumbnails
+from app.models import Reference, ReferenceDerivative, Upload
+
+
+# Reference upload pipeline
+#
+# A request only streams the upload into UPLOAD_FOLDER, hashing it as it
+# goes, and records an Upload row, then returns. A bounded thread pool pushes
+# the spooled file to S3 with a multipart, concurrent-part transfer, retrying
+# failed attempts with backoff, and creates the Reference once the object is
+# stored. Clients poll the Upload row's status to learn when the reference is
+# ready.
+#
+# Objects are stored under their SHA-256 digest and Reference.sha256 is
+# unique, so bytes that are already stored are linked to the existing
+# Reference without being transferred again.
+#
+# Browsers can also skip the app servers entirely: presign() hands out a
+# presigned POST for a fresh key, whose policy caps the size at
+# UPLOAD_MAX_BYTES, the browser sends the bytes to S3 and then calls back so
+# complete() can check the object. A worker then hashes it and moves it to
+# its content-addressed key, or links the existing Reference, the same as a
+# spooled upload.
+# Downloads are likewise redirected to presigned GET URLs.
+#
+# Image references then get thumbnail derivatives (see app/thumbnails.py),
+# stored next to the original in S3 and recorded on the Reference.
+#
+# Jobs only live in this process, so uploads a restart interrupted stay
+# pending or uploading with their spool files on disk; resume() queues them
+# again, and failed ones too when asked. clean() deletes the spool files of
+# uploads that failed long enough ago, and of any spool no Upload points at.
+
+SPOOL_CHUNK_SIZE = 64 * 1024
+
+
+class UploadPipeline(object):
+    def __init__(self):
+        self.executor = None
+        self._processes = None
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def init_app(self, app):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False)
+            self._processes = None
+        self.executor = ThreadPoolExecutor(max_workers=app.config['UPLOAD_WORKERS'],
+            thread_name_prefix='upload')
+        self._pending = set()
+        app.extensions['uploads'] = self
+
+    @property
+    def processes(self):
+        """Process pool for thumbnail generation, started on first use"""
+        with self._lock:
+            if self._processes is None:
+                self._processes = ProcessPoolExecutor(max_workers=current_app.config['THUMBNAIL_WORKERS'])
+            return self._processes
+
+    def transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+
+        config = current_app.config
+        return TransferConfig(multipart_threshold=config['S3_MULTIPART_THRESHOLD'],
+            multipart_chunksize=config['S3_MULTIPART_CHUNKSIZE'], max_concurrency=config['S3_MAX_CONCURRENCY'])
+
+    def spool(self, file):
+        """
+        Stream an uploaded FileStorage into the upload folder, hashing it on
+        the way, and return (spool path, SHA-256 hex digest)
+        """
+        folder = current_app.config['UPLOAD_FOLDER']
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        with open(path, 'wb') as spooled:
+            for chunk in iter(lambda: file.stream.read(SPOOL_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                spooled.write(chunk)
+        return path, digest.hexdigest()
+
+    def submit(self, file, user):
+        """Spool `file` for `user`, queue its transfer and return the new Upload"""
+        path, sha256 = self.spool(file)
+        upload = Upload(filename=secure_filename(file.filename) or 'upload', content_type=file.content_type,
+            key=content_key(sha256), sha256=sha256, path=path, user_id=user.id)
+        db.session.add(upload)
+
+        # identical bytes are already stored, so only the metadata link is needed
+        if self.link_existing(upload):
+            os.remove(path)
+            upload.path = None
+            db.session.commit()
+            return upload
+
+        db.session.commit()
+        self.queue(self.run, upload.id)
+        return upload
+
+    def queue(self, job, *args):
+        future = self.executor.submit(self.guard, job, current_app._get_current_object(), *args)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+
+    def guard(self, job, app, *args):
+        """Run a job, logging any exception it lets through rather than leaving it on an unread future"""
+        try:
+            job(app, *args)
+        except Exception:
+            app.logger.exception('Upload job {} failed'.format(getattr(job, '__name__', job)))
+
+    def wait(self, timeout=None):
+        """Block until every queued transfer has finished"""
+        wait(list(self._pending), timeout)
+
+    def run(self, app, id):
+        with app.app_context():
+            try:
+                self.process(Upload.query.get(id))
+            except Exception as e:
+                self.fail(app, id, e)
+
+    def fail(self, app, id, e):
+        db.session.rollback()
+        upload = Upload.query.get(id)
+        # a failure after the Reference was recorded only loses the cleanup
+        if upload.status != 'done':
+            upload.status = 'failed'
+            upload.error = str(e)
+            db.session.commit()
+        app.logger.exception('Upload {} of {} failed'.format(upload.id, upload.filename))
+
+    def process(self, upload):
+        if self.link_existing(upload):
+            self.discard_spool(upload)
+            db.session.commit()
+            return
+
+        upload.status = 'uploading'
+        db.session.commit()
+        self.transfer(upload)
+
+        self.finish(upload)
+        try:
+            db.session.commit()
+        except exc.IntegrityError:
+            # the same content finished uploading in another worker meanwhile
+            db.session.rollback()
+            self.link_existing(upload)
+            self.discard_spool(upload)
+            db.session.commit()
+            return
+
+        self.derive(upload.reference, upload.path, upload.content_type)
+        self.discard_spool(upload)
+        db.session.commit()
+
+    def resume(self, statuses=('pending', 'uploading')):
+        """Queue the transfer of every spooled Upload left in one of `statuses` and return their ids"""
+        unfinished = Upload.query.filter(Upload.status.in_(statuses), Upload.path.isnot(None)) \
+            .order_by(Upload.id).all()
+        ids = [upload.id for upload in unfinished]
+        for upload in unfinished:
+            if upload.status == 'failed':
+                # a retry gets the full UPLOAD_RETRIES again
+                upload.attempts = 0
+            upload.status = 'pending'
+        db.session.commit()
+        for id in ids:
+            self.queue(self.run, id)
+        return ids
+
+    def clean(self, max_age):
+        """
+        Delete the spool files of uploads that failed over `max_age` seconds
+        ago, and spool files older than that no Upload points at; return how
+        many files were removed
+        """
+        folder = current_app.config['UPLOAD_FOLDER']
+        cutoff = time.time() - max_age
+        removed = 0
+        failed = Upload.query.filter(Upload.status == 'failed', Upload.path.isnot(None),
+            Upload.created_at < datetime.utcfromtimestamp(cutoff)).all()
+        for upload in failed:
+            if os.path.exists(upload.path):
+                os.remove(upload.path)
+                removed += 1
+            upload.path = None
+        db.session.commit()
+
+        if not os.path.isdir(folder):
+            return removed
+        spooled = set(os.path.abspath(path) for path, in db.session.query(Upload.path).filter(Upload.path.isnot(None)))
+        for entry in os.scandir(folder):
+            # recent files may still be being written or waiting for their row's commit
+            if entry.is_file() and os.path.abspath(entry.path) not in spooled and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        return removed
+
+    def discard_spool(self, upload):
+        os.remove(upload.path)
+        upload.path = None
+
+    def run_direct(self, app, id):
+        """
+        Fetch a direct upload back from S3 to hash it, then move it to its
+        content-addressed key, or drop it for the stored copy of the same
+        bytes, and generate its thumbnails
+        """
+        with app.app_context():
+            upload = Upload.query.get(id)
+            bucket = app.config['S3_BUCKET']
+            uploaded_key = upload.key
+            path = os.path.join(app.config['UPLOAD_FOLDER'], uuid.uuid4().hex)
+            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+            try:
+                s3.download_file(bucket, uploaded_key, path, Config=self.transfer_config())
+                digest = hashlib.sha256()
+                with open(path, 'rb') as downloaded:
+                    for chunk in iter(lambda: downloaded.read(SPOOL_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                upload.sha256 = digest.hexdigest()
+
+                linked = self.link_existing(upload)
+                if not linked:
+                    upload.key = content_key(upload.sha256)
+                    s3.copy({'Bucket': bucket, 'Key': uploaded_key}, bucket, upload.key,
+                        ExtraArgs={'ContentType': upload.content_type or 'application/octet-stream'},
+                        Config=self.transfer_config())
+                    self.finish(upload)
+                try:
+                    db.session.commit()
+                except exc.IntegrityError:
+                    # the same content was stored by another upload meanwhile
+                    db.session.rollback()
+                    upload.sha256 = digest.hexdigest()
+                    linked = self.link_existing(upload)
+                    db.session.commit()
+                s3.delete_object(Bucket=bucket, Key=uploaded_key)
+
+                if not linked:
+                    self.derive(upload.reference, path, upload.content_type)
+                    db.session.commit()
+            except Exception as e:
+                self.fail(app, id, e)
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def derive(self, reference, path, content_type):
+        """Generate, store and record thumbnails of an image; a failure only costs the derivatives"""
+        config = current_app.config
+        if not thumbnails.supported(content_type):
+            if (content_type or '').startswith('image/'):
+                current_app.logger.warning('Pillow is not installed; {} gets no thumbnails'.format(reference.key))
+            return
+
+        try:
+            results = self.processes.submit(thumbnails.make_thumbnails, path, config['THUMBNAIL_SIZES'],
+                config['THUMBNAIL_FORMATS'], config['THUMBNAIL_QUALITY']).result()
+            for size, format, output, width, height in results:
+                key = thumbnails.derivative_key(reference.key, size, format)
+                s3.upload_file(output, config['S3_BUCKET'], key, ExtraArgs={'ContentType': 'image/' + format},
+                    Config=self.transfer_config())
+                reference.derivatives.append(ReferenceDerivative(size=size, format=format, key=key,
+                    width=width, height=height))
+        except Exception:
+            current_app.logger.exception('Thumbnails for {} failed'.format(reference.key))
+        finally:
+            for output in glob.glob(glob.escape(path) + '_*'):
+                os.remove(output)
+
+    def finish(self, upload, reference=None):
+        upload.reference = reference or Reference(key=upload.key, sha256=upload.sha256)
+        upload.status = 'done'
+        upload.error = None
+
+    def link_existing(self, upload):
+        """Finish `upload` with the stored Reference for the same content, if there is one"""
+        reference = Reference.query.filter_by(sha256=upload.sha256).first() if upload.sha256 else None
+        if reference is None:
+            return False
+        upload.key = reference.key
+        self.finish(upload, reference)
+        return True
+
+    def transfer(self, upload):
+        """Copy the spooled file to S3, retrying transient failures with exponential backoff"""
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        config = current_app.config
+        while True:
+            upload.attempts += 1
+            db.session.commit()
+            try:
+                s3.upload_file(upload.path, config['S3_BUCKET'], upload.key,
+                    ExtraArgs={'ContentType': upload.content_type or 'application/octet-stream'},
+                    Config=self.transfer_config())
+                return
+            except (BotoCoreError, ClientError, OSError) as e:
+                if upload.attempts >= config['UPLOAD_RETRIES']:
+                    raise
+                upload.error = str(e)
+                time.sleep(config['UPLOAD_RETRY_DELAY'] * 2 ** (upload.attempts - 1))
+
+    def presign(self, filename, content_type, user):
+        """
+        Record an Upload `user` will send straight to S3 and return the
+        presigned POST it should make: a form URL plus the fields to include.
+        """
+        config = current_app.config
+        upload = Upload(filename=secure_filename(filename) or 'upload', content_type=content_type, status='awaiting',
+            user_id=user.id)
+        upload.key = '{}/{}'.format(uuid.uuid4().hex, upload.filename)
+        db.session.add(upload)
+        db.session.flush()
+
+        request = s3.generate_presigned_post(config['S3_BUCKET'], upload.key,
+            Fields={'Content-Type': content_type},
+            Conditions=[{'Content-Type': content_type}, ['content-length-range', 1, config['UPLOAD_MAX_BYTES']]],
+            ExpiresIn=config['PRESIGNED_URL_EXPIRES'])
+        request['method'] = 'POST'
+        db.session.commit()
+        return upload, request
+
+    def complete(self, upload):
+        """
+        Queue a direct upload for hashing and recording once S3 has the
+        object and return True; return False if it isn't there yet, or if it
+        is too large, in which case the object is deleted and the upload failed.
+        """
+        from botocore.exceptions import ClientError
+
+        if upload.status != 'awaiting':
+            return upload.status != 'failed'
+
+        try:
+            head = s3.head_object(Bucket=current_app.config['S3_BUCKET'], Key=upload.key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        if head['ContentLength'] > current_app.config['UPLOAD_MAX_BYTES']:
+            s3.delete_object(Bucket=current_app.config['S3_BUCKET'], Key=upload.key)
+            upload.status = 'failed'
+            upload.error = 'larger than {:d} bytes'.format(current_app.config['UPLOAD_MAX_BYTES'])
+            db.session.commit()
+            return False
+
+        upload.status = 'pending'
+        db.session.commit()
+        self.queue(self.run_direct, upload.id)
+        return True
+
+
+def presigned_download(reference, width=None):
+    """
+    Return a short-lived URL the browser can fetch a reference from directly,
+    pointing at the smallest thumbnail covering `width` pixels when given, or
+    at the original when no thumbnail is that wide
+    """
+    derivative = reference.best_derivative(width) if width else None
+    return s3.generate_presigned_url('get_object', Params={'Bucket': current_app.config['S3_BUCKET'],
+        'Key': derivative.key if derivative else reference.key}, ExpiresIn=current_app.config['PRESIGNED_URL_EXPIRES'])
+
+
+def content_key(sha256):
+    """Return the S3 key content with this SHA-256 digest is stored under"""
+    return '{}/{}'.format(sha256[:2], sha256)
+
+
+uploads = UploadPipeline()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Time association table lookups with and without the composite keys
+
+Builds book_tags twice in in-memory SQLite databases, once as the original
+unkeyed table and once as defined in app.models (primary key plus reverse
+index), fills both with the same random pairs and times membership checks
+("is this book tagged X?") and reverse lookups ("all books tagged X").
+
+    python benchmarks/association_lookup.py [rows]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from sqlalchemy import create_engine, select, bindparam, MetaData, Table, Column, Integer
+from app.models import book_tags
+
+
+def unkeyed_table():
+    return Table('book_tags', MetaData(), Column('tag_id', Integer), Column('book_id', Integer))
+
+
+def build(table, pairs):
+    engine = create_engine('sqlite://')
+    table.create(engine)
+    with engine.begin() as connection:
+        connection.execute(table.insert(), [{'book_id': b, 'tag_id': t} for b, t in pairs])
+    return engine
+
+
+def timed(engine, statement, params):
+    with engine.connect() as connection:
+        start = time.perf_counter()
+        for p in params:
+            connection.execute(statement, p).fetchall()
+        return (time.perf_counter() - start) / len(params) * 1e6
+
+
+def main(rows):
+    random.seed(0)
+    books, tags = rows // 4, 500
+    pairs = set()
+    while len(pairs) < rows:
+        pairs.add((random.randint(1, books), random.randint(1, tags)))
+    pairs = list(pairs)
+
+    membership = [{'b': random.randint(1, books), 't': random.randint(1, tags)} for _ in range(2000)]
+    reverse = [{'t': random.randint(1, tags)} for _ in range(200)]
+
+    print('{} rows, {} books, {} tags (mean microseconds per lookup)'.format(rows, books, tags))
+    print('{:<10} {:>12} {:>12}'.format('', 'membership', 'reverse'))
+    for label, table in (('before', unkeyed_table()), ('after', book_tags)):
+        engine = build(table, pairs)
+        c = table.c
+        is_tagged = select(c.book_id).where(c.book_id == bindparam('b')).where(c.tag_id == bindparam('t'))
+        tagged = select(c.book_id).where(c.tag_id == bindparam('t'))
+        print('{:<10} {:>12.1f} {:>12.1f}'.format(label, timed(engine, is_tagged, membership), timed(engine, tagged, reverse)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
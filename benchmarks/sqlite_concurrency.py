@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Concurrent read/write throughput of SQLite with and without the engine profile
+
+Runs the same workload against a fresh database file twice: once with
+SQLite's defaults (rollback journal, a new connection per checkout, as
+Flask-SQLAlchemy sets up file databases) and once with the profile from
+app.database (WAL and the other SQLITE_PRAGMAS, pooled connections). Reader
+threads look up books by id and scan short title ranges while one writer
+thread updates rows in small transactions, like a bulk edit. Prints operations
+per second and how many operations failed with "database is locked".
+
+    python benchmarks/sqlite_concurrency.py [seconds] [readers]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from sqlalchemy import create_engine, event, exc, select, update, bindparam, MetaData, Table, Column, Index, Integer, Text
+from sqlalchemy.pool import NullPool, QueuePool
+from app.database import sqlite_pragmas, begin
+from config import Config
+
+ROWS = 20000
+
+book = Table('book', MetaData(), Column('id', Integer, primary_key=True), Column('title', Text),
+    Column('series_number', Integer), Index('ix_book_title', 'title'))
+
+
+def default_engine(path):
+    return create_engine('sqlite:///' + path, poolclass=NullPool)
+
+
+def tuned_engine(path):
+    engine = create_engine('sqlite:///' + path, poolclass=QueuePool, pool_size=8, max_overflow=8,
+        connect_args={'check_same_thread': False})
+    event.listen(engine, 'connect', sqlite_pragmas(Config.SQLITE_PRAGMAS))
+    event.listen(engine, 'begin', begin)
+    return engine
+
+
+def build(engine):
+    book.create(engine)
+    with engine.begin() as connection:
+        connection.execute(book.insert(), [{'title': 'Book {:05d}'.format(i)} for i in range(ROWS)])
+
+
+def reader(engine, stop, counts):
+    by_id = select(book.c.title).where(book.c.id == bindparam('id'))
+    by_title = select(book.c.id).where(book.c.title >= bindparam('title')).order_by(book.c.title).limit(20)
+    while not stop.is_set():
+        try:
+            with engine.connect() as connection:
+                connection.execute(by_id, {'id': random.randint(1, ROWS)}).fetchall()
+                connection.execute(by_title, {'title': 'Book {:05d}'.format(random.randint(0, ROWS))}).fetchall()
+            counts['reads'] += 1
+        except exc.OperationalError:
+            counts['locked'] += 1
+
+
+def writer(engine, stop, counts):
+    statement = update(book).where(book.c.id == bindparam('book_id')).values(series_number=bindparam('number'))
+    while not stop.is_set():
+        try:
+            with engine.begin() as connection:
+                connection.execute(statement, [{'book_id': random.randint(1, ROWS), 'number': random.randint(1, 9)}
+                    for _ in range(50)])
+            counts['writes'] += 1
+        except exc.OperationalError:
+            counts['locked'] += 1
+
+
+def run(make_engine, seconds, readers):
+    folder = tempfile.mkdtemp()
+    try:
+        engine = make_engine(os.path.join(folder, 'bench.db'))
+        build(engine)
+        stop = threading.Event()
+        counts = {'reads': 0, 'writes': 0, 'locked': 0}
+        threads = [threading.Thread(target=reader, args=(engine, stop, counts)) for _ in range(readers)]
+        threads.append(threading.Thread(target=writer, args=(engine, stop, counts)))
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+        return counts
+    finally:
+        shutil.rmtree(folder)
+
+
+def main(seconds, readers):
+    random.seed(0)
+    print('{} reader threads, 1 writer thread, {}s each (operations per second)'.format(readers, seconds))
+    print('{:<10} {:>10} {:>10} {:>10}'.format('', 'reads', 'writes', 'locked'))
+    for label, make_engine in (('default', default_engine), ('tuned', tuned_engine)):
+        counts = run(make_engine, seconds, readers)
+        print('{:<10} {:>10.0f} {:>10.0f} {:>10}'.format(label, counts['reads'] / seconds, counts['writes'] / seconds,
+            counts['locked']))
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 5, int(sys.argv[2]) if len(sys.argv) > 2 else 4)
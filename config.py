@@ -8,7 +8,52 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or  'sqlite:///' + os.path.join(basedir, 'library.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_BINDS = {'replica': os.environ['DATABASE_REPLICA_URL']} if os.environ.get('DATABASE_REPLICA_URL') else {}
+    REPLICA_LAG_WINDOW = 5
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30}
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'foreign_keys': 'ON',
+    }
     S3_BUCKET = os.environ.get('S3_BUCKET_NAME')
     S3_KEY = os.environ.get('AWS_ACCESS_KEY')
     S3_SECRET = os.environ.get('AWS_ACCESS_SECRET')
-    S3_LOCATION = 'http://{}.s3.amazonaws.com/'.format(os.environ.get('S3_BUCKET_NAME'))
\ No newline at end of file
+    S3_LOCATION = 'http://{}.s3.amazonaws.com/'.format(os.environ.get('S3_BUCKET_NAME'))
+    S3_REGION = os.environ.get('S3_REGION')
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+    S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS') or 32)
+    S3_MAX_ATTEMPTS = 5
+    S3_CONNECT_TIMEOUT = 5
+    S3_READ_TIMEOUT = 60
+    RESOURCES_PER_PAGE = 25
+    MAX_RESOURCES_PER_PAGE = 100
+    # 'fts5', 'like' or 'none'; FTS5 on SQLite and LIKE elsewhere by default
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_RESULTS = 50
+    CHOICES_CACHE_TIMEOUT = 300
+    AUTOCOMPLETE_RESULTS = 10
+    MAX_AUTOCOMPLETE_RESULTS = 50
+    FRAGMENT_CACHE_URL = os.environ.get('FRAGMENT_CACHE_URL')
+    FRAGMENT_CACHE_BYTES = int(os.environ.get('FRAGMENT_CACHE_BYTES') or 32 * 1024 * 1024)
+    FRAGMENT_CACHE_TIMEOUT = 3600
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TIMEOUT = 300
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(basedir, 'uploads')
+    UPLOAD_WORKERS = 4
+    UPLOAD_RETRIES = 3
+    UPLOAD_RETRY_DELAY = 1
+    UPLOAD_SPOOL_RETENTION = 7 * 24 * 3600
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    S3_MAX_CONCURRENCY = 4
+    UPLOAD_MAX_BYTES = 50 * 1024 * 1024
+    PRESIGNED_URL_EXPIRES = 3600
+    THUMBNAIL_SIZES = (160, 320, 640, 1280)
+    THUMBNAIL_FORMATS = ('webp', 'jpeg')
+    THUMBNAIL_QUALITY = 80
+    THUMBNAIL_WORKERS = 2
+    RELATED_TOP_K = 20
\ No newline at end of file
@@ -1,8 +1,9 @@
-from app import create_app, db
+from app import create_app, db, cli
 from app.models import User, Actor, Tag, Book, Character, Author, Universe
 
 
 app = create_app()
+cli.register(app)
 
 
 @app.shell_context_processor
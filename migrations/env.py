@@ -1,6 +1,7 @@
 from __future__ import with_statement
 
 import logging
+import re
 from logging.config import fileConfig
 
 from flask import current_app
@@ -70,19 +71,38 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # full-text search tables are virtual tables maintained by app.search, not models,
+    # and expression indexes (lower(...)) can't be reflected, so autogenerate skips both
+    def include_object(object, name, type_, reflected, compare_to):
+        if type_ == 'table' and re.search(r'_fts($|_)', name):
+            return False
+        if type_ == 'index' and re.match(r'ix_\w+_lower_', name):
+            return False
+        return True
+
     connectable = current_app.extensions['migrate'].db.engine
 
     with connectable.connect() as connection:
+        # batch mode copies and drops tables, which must not trip the foreign key checks
+        # the app turns on; the pragma only takes effect outside a transaction
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            connection.connection.execute('PRAGMA foreign_keys = OFF')
+
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
         with context.begin_transaction():
             context.run_migrations()
 
+        if sqlite:
+            connection.connection.execute('PRAGMA foreign_keys = ON')
+
 
 if context.is_offline_mode():
     run_migrations_offline()
@@ -0,0 +1,39 @@
+"""empty message
+
+Revision ID: 5b0f3d7e9a21
+Revises: e2b7c9a41d06
+Create Date: 2026-10-18 20:47:51.603118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0f3d7e9a21'
+down_revision = 'e2b7c9a41d06'
+branch_labels = None
+depends_on = None
+
+
+prefix_columns = [
+    ('actor', 'first_name'),
+    ('actor', 'last_name'),
+    ('author', 'first_name'),
+    ('author', 'last_name'),
+    ('book', 'title'),
+    ('character', 'first_name'),
+    ('character', 'last_name'),
+    ('series', 'title'),
+    ('universe', 'title'),
+]
+
+
+def upgrade():
+    for table, column in prefix_columns:
+        op.create_index('ix_{}_lower_{}'.format(table, column), table, [sa.text('lower({})'.format(column))], unique=False)
+
+
+def downgrade():
+    for table, column in reversed(prefix_columns):
+        op.drop_index('ix_{}_lower_{}'.format(table, column), table_name=table)
@@ -0,0 +1,45 @@
+"""empty message
+
+Revision ID: c5a1d2e8f3b7
+Revises: a319b496a4c9
+Create Date: 2026-10-18 19:41:10.512873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5a1d2e8f3b7'
+down_revision = 'a319b496a4c9'
+branch_labels = None
+depends_on = None
+
+
+searchable = {
+    'actor': ['first_name', 'middle_name', 'last_name', 'suffix'],
+    'art': ['title', 'description', 'artist'],
+    'author': ['first_name', 'middle_name', 'last_name', 'suffix'],
+    'book': ['title'],
+    'character': ['first_name', 'last_name', 'suffix', 'description'],
+    'series': ['title'],
+    'universe': ['title'],
+}
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    for table, fields in searchable.items():
+        op.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {}_fts USING fts5({}, tokenize="unicode61 remove_diacritics 2")'.format(
+            table, ', '.join(fields)))
+        op.execute('INSERT INTO {0}_fts (rowid, {1}) SELECT id, {1} FROM {0}'.format(table, ', '.join(fields)))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    for table in searchable:
+        op.execute('DROP TABLE IF EXISTS {}_fts'.format(table))
@@ -0,0 +1,71 @@
+"""empty message
+
+Revision ID: e2b7c9a41d06
+Revises: c5a1d2e8f3b7
+Create Date: 2026-10-18 20:02:37.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b7c9a41d06'
+down_revision = 'c5a1d2e8f3b7'
+branch_labels = None
+depends_on = None
+
+
+# (table, owner column, target column); the primary key is (owner, target)
+# and the reverse index is (target, owner)
+associations = [
+    ('actor_tags', 'actor_id', 'tag_id'),
+    ('art_tags', 'art_id', 'tag_id'),
+    ('book_tags', 'book_id', 'tag_id'),
+    ('character_tags', 'character_id', 'tag_id'),
+    ('series_tags', 'series_id', 'tag_id'),
+    ('universe_tags', 'universe_id', 'tag_id'),
+    ('reference_tags', 'reference_id', 'tag_id'),
+    ('actor_refs', 'actor_id', 'reference_id'),
+    ('art_refs', 'art_id', 'reference_id'),
+    ('character_refs', 'character_id', 'reference_id'),
+    ('appearances', 'character_id', 'book_id'),
+]
+
+
+def dedupe(table, owner, target):
+    """Collapse duplicate pairs and drop half-empty rows so the new key can be created"""
+    op.execute('CREATE TEMPORARY TABLE _dedupe AS SELECT DISTINCT {1}, {2} FROM {0} '
+        'WHERE {1} IS NOT NULL AND {2} IS NOT NULL'.format(table, owner, target))
+    op.execute('DELETE FROM {}'.format(table))
+    op.execute('INSERT INTO {0} ({1}, {2}) SELECT {1}, {2} FROM _dedupe'.format(table, owner, target))
+    op.execute('DROP TABLE _dedupe')
+
+
+def upgrade():
+    # reference_tags was added to the models without a migration
+    if not sa.inspect(op.get_bind()).has_table('reference_tags'):
+        op.create_table('reference_tags',
+        sa.Column('tag_id', sa.Integer(), nullable=True),
+        sa.Column('reference_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['reference_id'], ['reference.id'], name=op.f('fk_reference_tags_reference_id_reference')),
+        sa.ForeignKeyConstraint(['tag_id'], ['tag.id'], name=op.f('fk_reference_tags_tag_id_tag'))
+        )
+
+    for table, owner, target in associations:
+        dedupe(table, owner, target)
+
+        with op.batch_alter_table(table, schema=None, recreate='always') as batch_op:
+            batch_op.alter_column(owner, existing_type=sa.INTEGER(), nullable=False)
+            batch_op.alter_column(target, existing_type=sa.INTEGER(), nullable=False)
+            batch_op.create_primary_key(op.f('pk_{}'.format(table)), [owner, target])
+            batch_op.create_index('ix_{}_{}'.format(table, target), [target, owner], unique=False)
+
+
+def downgrade():
+    for table, owner, target in reversed(associations):
+        with op.batch_alter_table(table, schema=None, recreate='always') as batch_op:
+            batch_op.drop_index('ix_{}_{}'.format(table, target))
+            batch_op.drop_constraint(op.f('pk_{}'.format(table)), type_='primary')
+            batch_op.alter_column(target, existing_type=sa.INTEGER(), nullable=True)
+            batch_op.alter_column(owner, existing_type=sa.INTEGER(), nullable=True)
@@ -1,12 +1,39 @@
 #!/usr/bin/env python
+import base64
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
-from app import create_app, db
-from app.models import User
+from datetime import datetime, timedelta
+from werkzeug.datastructures import FileStorage
+from app import create_app, db, s3
+from app import related
+from app.models import counters, load_user, sort_keys, sortable_columns, Reference, ReferenceDerivative, RelatedDirty, Upload, User, Author, Book, Character, Series, Tag, TagBase, TagType, Universe
+from sqlalchemy import event, inspect, text
+from app.pagination import encode_cursor, keyset_paginate
+from app.search import FTS5Index, LikeSearch
+from app.cache import choice_cache, fragment_cache, user_cache, LRUCache
+from app.importer import import_file
+from app import cli, startup, thumbnails
+from app.thumbnails import derivative_key
+from app.uploads import uploads, content_key, presigned_download
 from config import Config
 
+try:
+    import moto
+except ImportError:
+    moto = None
+
 
 class TestConfig(Config):
     TESTING = True
+    WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
 
 
@@ -28,6 +55,36 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_user_loader_cache(self):
+        user_cache.clear()
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+        client.get('/api/metrics')
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            metrics = client.get('/api/metrics').json['user_cache']
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(statements, [])
+        self.assertEqual((metrics['hits'], metrics['misses']), (1, 1))
+
+        cached = load_user('1')
+        self.assertEqual((cached.username, inspect(cached).detached), ('susan', True))
+
+        u.email = 'susan@example.org'
+        db.session.commit()
+        self.assertEqual(load_user('1').email, 'susan@example.org')
+        self.assertIsNone(load_user('2'))
+        self.assertEqual(user_cache.stats()['misses'], 3)
+
     # def test_avatar(self):
     #     u = User(username='john', email='john@example.com')
     #     self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
@@ -96,5 +153,1040 @@ class UserModelCase(unittest.TestCase):
     #     self.assertEqual(f4, [p4])
 
 
+class ResourceListingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def titles(self, response):
+        return re.findall(r'<td><span>(Book \d+)</span></td>', response.get_data(as_text=True))
+
+    def link(self, response, rel):
+        match = re.search(r'<li class="{}">\s*<a href="([^"]+)"'.format(rel), response.get_data(as_text=True))
+        return match.group(1).replace('&amp;', '&') if match else None
+
+    def test_keyset_pagination(self):
+        db.session.add_all([Book(title='Book {}'.format(i)) for i in range(7, 0, -1)])
+        db.session.commit()
+
+        first = self.client.get('/books?per_page=3')
+        self.assertEqual(self.titles(first), ['Book 1', 'Book 2', 'Book 3'])
+        self.assertIsNone(self.link(first, 'previous'))
+
+        second = self.client.get(self.link(first, 'next'))
+        self.assertEqual(self.titles(second), ['Book 4', 'Book 5', 'Book 6'])
+
+        last = self.client.get(self.link(second, 'next'))
+        self.assertEqual(self.titles(last), ['Book 7'])
+        self.assertIsNone(self.link(last, 'next'))
+
+        back = self.client.get(self.link(last, 'previous'))
+        self.assertEqual(self.titles(back), ['Book 4', 'Book 5', 'Book 6'])
+
+        self.assertEqual(self.client.get('/books?after=garbage').status_code, 400)
+        self.assertEqual(self.client.get('/books?after=' + encode_cursor([{'a': 1}, 2])).status_code, 400)
+        self.assertEqual(self.client.get('/books?before=' + encode_cursor(['Book 4', [4]])).status_code, 400)
+
+    def count_queries_for(self, url, **kwargs):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get(url, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return response.status_code, len(statements)
+
+    def count_queries(self, url):
+        status, count = self.count_queries_for(url)
+        self.assertEqual(status, 200)
+        return count
+
+    def add_books(self, start, stop):
+        for i in range(start, stop):
+            universe = Universe(title='Universe {}'.format(i))
+            db.session.add(Book(title='Book {}'.format(i), universe=universe,
+                series=Series(title='Series {}'.format(i), universe=universe),
+                author=Author(first_name='First', last_name='Last {}'.format(i))))
+        db.session.commit()
+        db.session.expunge_all()
+
+    def test_list_query_count_is_constant(self):
+        self.add_books(0, 2)
+        few = self.count_queries('/books')
+        self.add_books(2, 20)
+        many = self.count_queries('/books')
+        self.assertEqual(few, many)
+        self.assertEqual(self.count_queries('/books/1'), self.count_queries('/books/2'))
+
+    def test_form_choices_are_cached(self):
+        choice_cache.clear()
+        self.add_books(0, 3)
+        self.count_queries('/books/add')
+        self.assertEqual(self.count_queries('/books/add'), 0)
+
+        db.session.add_all([Universe(title='Randland'), Author(first_name='Robert', last_name='Jordan')])
+        db.session.commit()
+        self.assertIn('Randland', self.client.get('/books/add').get_data(as_text=True))
+
+        response = self.client.post('/books/1/edit', data={'title': 'Book 0', 'series': '3', 'author': '__None',
+            'universe': '__None', 'coauthor': '4'})
+        self.assertEqual(response.status_code, 302)
+        book = Book.query.get(1)
+        self.assertEqual((book.series.title, book.author, book.coauthor.full_name), ('Series 2', None, 'Robert Jordan'))
+
+        response = self.client.post('/books/1/edit', data={'title': 'Book 0', 'series': '99'})
+        self.assertIn('Not a valid choice', response.get_data(as_text=True))
+
+        # autocomplete fields render only the current selection
+        page = self.client.get('/books/1/edit').get_data(as_text=True)
+        self.assertIn('value="Robert Jordan"', page)
+        self.assertNotIn('Series 1', page)
+
+    def test_choices_loaded_across_a_commit_are_not_stored(self):
+        choice_cache.clear()
+
+        def loader():
+            # a write lands while the options are being read
+            choice_cache.invalidate({'series'})
+            return [(1, 'Stale')]
+
+        self.assertEqual(choice_cache.get('series', ['series'], loader)[0], [(1, 'Stale')])
+        self.assertEqual(choice_cache.get('series', ['series'], lambda: [(1, 'Fresh')])[0], [(1, 'Fresh')])
+        self.assertEqual(choice_cache.get('series', ['series'], lambda: [])[0], [(1, 'Fresh')])
+
+    def test_autocomplete(self):
+        self.add_books(0, 12)
+        db.session.add(Author(first_name='Lasty', last_name='Other'))
+        db.session.commit()
+
+        results = self.client.get('/api/autocomplete/author?q=LAS&limit=3').json['results']
+        self.assertEqual([r['label'] for r in results], ['First Last 0', 'First Last 1', 'First Last 10'])
+        results = self.client.get('/api/autocomplete/author?q=lasty').json['results']
+        self.assertEqual(results, [{'id': 13, 'label': 'Lasty Other'}])
+        self.assertEqual(self.client.get('/api/autocomplete/series?q=').json['results'], [])
+        self.assertEqual(self.client.get('/api/autocomplete/user?q=a').status_code, 404)
+        for q in ('\U0010ffff', 'la\U0010ffff', '\ud7ff'):
+            response = self.client.get('/api/autocomplete/author', query_string={'q': q})
+            self.assertEqual((response.status_code, response.json['results']), (200, []))
+
+    def test_conditional_get(self):
+        self.add_books(0, 2)
+        first = self.client.get('/books')
+        etag = first.headers['ETag']
+        self.assertNotIn('Last-Modified', first.headers)
+
+        self.assertEqual(self.count_queries_for('/books', headers={'If-None-Match': etag}), (304, 1))
+        self.assertEqual(self.client.get('/books', headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'}).status_code, 200)
+        self.assertEqual(self.client.get('/books?per_page=1', headers={'If-None-Match': etag}).status_code, 200)
+
+        # a write to a table the page shows invalidates it; unrelated tables don't
+        db.session.add(Character(first_name='Vin', series_id=1))
+        db.session.commit()
+        self.assertEqual(self.client.get('/books', headers={'If-None-Match': etag}).status_code, 304)
+        Series.query.get(1).title = 'Renamed'
+        db.session.commit()
+        self.assertEqual(self.client.get('/books', headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_table_fragment_cache(self):
+        self.add_books(0, 3)
+        first = self.count_queries('/books')
+        # only the version lookup runs once the table fragment is cached
+        self.assertEqual(self.count_queries('/books'), 1)
+        self.assertLess(1, first)
+        self.assertEqual(len(fragment_cache._index['book']), 1)
+
+        # a write drops the fragments built from its tables and nothing else
+        self.client.get('/series')
+        self.client.get('/authors')
+        db.session.add(Author(first_name='Brandon', last_name='Sanderson'))
+        db.session.commit()
+        self.assertEqual(sorted(fragment_cache._index), ['series', 'series_tags', 'tag', 'tag_type', 'universe'])
+        db.session.add(Universe(title='Cosmere'))
+        db.session.commit()
+        self.assertEqual(fragment_cache._index, {})
+
+        Book.query.get(1).title = 'Book 9'
+        db.session.commit()
+        self.assertEqual(self.titles(self.client.get('/books')), ['Book 1', 'Book 2', 'Book 9'])
+
+    def test_tag_facets(self):
+        genre, mood = TagType(name='Genre'), TagType(name='Mood')
+        fantasy, heist, grim = Tag(name='fantasy', tag_type=genre), Tag(name='heist', tag_type=genre), Tag(name='grim', tag_type=mood)
+        books = [Book(title='Book {}'.format(i)) for i in range(1, 5)]
+        db.session.add_all(books)
+        db.session.commit()
+        TagBase.tag_many([(books[0], fantasy), (books[1], fantasy), (books[2], fantasy), (books[0], heist),
+            (books[3], heist), (books[0], grim), (books[2], grim)])
+        db.session.commit()
+        facets = lambda response: re.findall(r'>(\w+) <span class="badge">(\d+)</span>', response.get_data(as_text=True))
+
+        response = self.client.get('/books')
+        self.assertEqual(self.titles(response), ['Book 1', 'Book 2', 'Book 3', 'Book 4'])
+        self.assertEqual(facets(response), [('fantasy', '3'), ('heist', '2'), ('grim', '2')])
+        self.assertLess(response.get_data(as_text=True).index('Genre'), response.get_data(as_text=True).index('Mood'))
+
+        response = self.client.get('/books?tag={}&tag={}'.format(fantasy.id, grim.id))
+        self.assertEqual(self.titles(response), ['Book 1', 'Book 3'])
+        self.assertEqual(facets(response), [('fantasy', '2'), ('heist', '1'), ('grim', '2')])
+
+        response = self.client.get('/books?tag={}&tag={}&match=any&per_page=2'.format(heist.id, grim.id))
+        self.assertEqual(self.titles(response), ['Book 1', 'Book 3'])
+        self.assertIn('match=any', self.link(response, 'next'))
+        self.assertEqual(self.titles(self.client.get(self.link(response, 'next'))), ['Book 4'])
+
+        # facet counts come from one grouped query, not per-tag lookups
+        fragment_cache.clear()
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        self.client.get('/books?tag={}'.format(heist.id))
+        event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(len([s for s in statements if 'tag_type' in s and 'GROUP BY tag.id' in s]), 1)
+        self.assertEqual(len([s for s in statements if 'FROM tag' in s or 'JOIN tag ' in s]), 1)
+
+        self.assertEqual(self.client.get('/books?match=some').status_code, 400)
+        self.assertNotIn('tag-facets', self.client.get('/authors').get_data(as_text=True))
+
+    def test_sorted_listing(self):
+        mistborn, stormlight = Series(title='Mistborn'), Series(title='Stormlight')
+        db.session.add_all([Book(title='Book 1', series=stormlight, series_number=2),
+            Book(title='Book 2', series=mistborn, series_number=1), Book(title='Book 3', series_number=3),
+            Book(title='Book 4', series=mistborn, series_number=3), Book(title='Book 5', series=stormlight, series_number=1)])
+        db.session.commit()
+
+        first = self.client.get('/books?sort=series_number&dir=desc&per_page=2')
+        self.assertEqual(self.titles(first), ['Book 4', 'Book 3'])
+        second = self.client.get(self.link(first, 'next'))
+        self.assertEqual(self.titles(second), ['Book 1', 'Book 5'])
+        self.assertEqual(self.titles(self.client.get(self.link(second, 'next'))), ['Book 2'])
+        self.assertEqual(self.titles(self.client.get(self.link(second, 'previous'))), ['Book 4', 'Book 3'])
+        self.assertIn('href="/books?per_page=2&amp;sort=series_number"', first.get_data(as_text=True))
+
+        # relationship columns sort by the related row's sort key, books without one first
+        first = self.client.get('/books?sort=series&per_page=3')
+        self.assertEqual(self.titles(first), ['Book 3', 'Book 2', 'Book 4'])
+        self.assertEqual(self.titles(self.client.get(self.link(first, 'next'))), ['Book 1', 'Book 5'])
+        self.assertEqual(self.titles(self.client.get('/books?sort=series&dir=desc')),
+            ['Book 5', 'Book 1', 'Book 4', 'Book 2', 'Book 3'])
+
+        # the copied sort keys follow renames, moves and deletes of the related rows
+        mistborn.title = 'Wax and Wayne'
+        Book.query.filter_by(title='Book 3').one().series = stormlight
+        db.session.commit()
+        self.assertEqual(self.titles(self.client.get('/books?sort=series')), ['Book 1', 'Book 3', 'Book 5', 'Book 2', 'Book 4'])
+        db.session.delete(stormlight)
+        db.session.commit()
+        self.assertEqual(self.titles(self.client.get('/books?sort=series')), ['Book 1', 'Book 3', 'Book 5', 'Book 2', 'Book 4'])
+        self.assertEqual([book.series_sort for book in Book.query.order_by(Book.title)],
+            [None, 'Wax and Wayne', None, 'Wax and Wayne', None])
+        book = Book.query.get(1)
+        book.author = Author(first_name='Brandon', last_name='Sanderson')
+        db.session.commit()
+        self.assertEqual(book.author_sort, 'Sanderson\x1fBrandon')
+
+        self.assertEqual(self.client.get('/books?sort=isbn').status_code, 400)
+        self.assertEqual(self.client.get('/books?sort=characters').status_code, 400)
+        self.assertEqual(self.client.get('/books?sort=title&dir=up').status_code, 400)
+
+    def test_sorts_use_indexes(self):
+        for ResourceClass, names in sortable_columns.items():
+            for name in names:
+                for descending in (False, True):
+                    order, keys = ResourceClass.sort_order(name, descending)
+                    # joined the way the list page loads its relationship columns
+                    query = ResourceClass.query.options(*ResourceClass.loader_options(names))
+                    statements = []
+                    listener = lambda conn, cursor, statement, parameters, *args: statements.append((statement, parameters))
+                    event.listen(db.engine, 'before_cursor_execute', listener)
+                    keyset_paginate(query, order, keys, 20)
+                    keyset_paginate(query, order, keys, 20, after=encode_cursor([None] * (len(order) - 1) + [0]))
+                    event.remove(db.engine, 'before_cursor_execute', listener)
+                    for statement, parameters in statements:
+                        plan = ' '.join(row[-1] for row in
+                            db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters))
+                        self.assertNotIn('TEMP B-TREE', plan, (ResourceClass.__name__, name, descending))
+
+    def test_lru_cache_byte_budget(self):
+        cache = LRUCache(10)
+        cache.set('a', b'1234')
+        cache.set('b', b'1234')
+        cache.get('a')
+        self.assertEqual(cache.set('c', b'1234'), ['b'])
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.size), (b'1234', None, 8))
+        self.assertEqual(cache.set('d', b'x' * 11), [])
+        self.assertIsNone(cache.get('d'))
+
+    def test_export(self):
+        self.add_books(0, 3)
+        book = Book.query.get(2)
+        TagBase.tag_many([(book, Tag(name='fantasy')), (book, Tag(name='epic'))])
+        db.session.commit()
+
+        response = self.client.get('/books/export')
+        self.assertEqual(response.mimetype, 'text/csv')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'id,universe_id,series_id,author_id,coauthor_id,title,series_number,'
+            'universe,series,author,coauthor,tags')
+        self.assertEqual(lines[2], '2,2,2,2,,Book 1,,Universe 1,Series 1,First Last 1,,epic;fantasy')
+
+        records = [json.loads(line) for line in self.client.get('/books/export?format=ndjson').get_data(as_text=True).splitlines()]
+        self.assertEqual([r['title'] for r in records], ['Book 0', 'Book 1', 'Book 2'])
+        self.assertEqual(records[1]['tags'], ['epic', 'fantasy'])
+        self.assertEqual(self.client.get('/books/export?format=xml').status_code, 400)
+
+
+class SearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_index_follows_session(self):
+        series = Series(title='The Stormlight Archive')
+        kaladin = Character(first_name='Kaladin', description='Bridgeman turned Windrunner', series=series)
+        db.session.add_all([series, kaladin, Book(title='The Way of Kings', series=series)])
+        db.session.commit()
+
+        self.assertEqual([c for c, score in Character.search('wind', 10)], [kaladin])
+        self.assertEqual([s for s, score in Series.search('storm arch', 10)], [series])
+        self.assertEqual(Book.search('storm', 10), [])
+
+        kaladin.description = 'Stormblessed'
+        db.session.commit()
+        self.assertEqual(Character.search('wind', 10), [])
+        self.assertEqual([c for c, score in Character.search('stormbl', 10)], [kaladin])
+
+        db.session.delete(kaladin)
+        db.session.commit()
+        self.assertEqual(Character.search('stormbl', 10), [])
+
+    def test_rollback_discards_index_changes(self):
+        db.session.add(Book(title='Mistborn'))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(Book.search('mist', 10), [])
+
+    def test_search_page_ranks_across_types(self):
+        db.session.add_all([Book(title='Elantris'), Author(first_name='Brandon', last_name='Sanderson')])
+        db.session.commit()
+
+        response = self.app.test_client().get('/search?q=sand')
+        self.assertIn('Brandon Sanderson', response.get_data(as_text=True))
+        self.assertNotIn('Elantris', response.get_data(as_text=True))
+
+    def test_backend_follows_dialect(self):
+        class PostgresConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'postgresql://localhost/library'
+        self.assertIsInstance(self.app.search_index, FTS5Index)
+        self.assertIsInstance(create_app(PostgresConfig).search_index, LikeSearch)
+
+    def test_like_search(self):
+        self.app.search_index = LikeSearch()
+        series = Series(title='The Stormlight Archive')
+        kaladin = Character(first_name='Kaladin', description='Bridgeman turned Windrunner', series=series)
+        db.session.add_all([series, kaladin, Character(first_name='Shallan', description='100% Lightweaver', series=series)])
+        db.session.commit()
+
+        self.assertEqual([c for c, score in Character.search('WIND kal', 10)], [kaladin])
+        self.assertEqual(Character.search('wind shallan', 10), [])
+        self.assertEqual(Character.search('%', 10), [])
+
+
+class AliasGraphCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_alias_traversal(self):
+        series = Series(title='Warbreaker')
+        vasher = Character(first_name='Vasher', series=series)
+        zahel = Character(first_name='Zahel', series=series, parent=vasher)
+        kalad = Character(first_name='Kalad', series=series, parent=vasher)
+        peacegiver = Character(first_name='Peacegiver', series=series, parent=kalad)
+        vivenna = Character(first_name='Vivenna', series=series)
+        kaladin = Character(first_name='Kaladin', series=series)
+        warbreaker, oathbringer, words = Book(title='Warbreaker'), Book(title='Oathbringer'), Book(title='Words of Radiance')
+        vasher.books.append(warbreaker)
+        peacegiver.books.append(warbreaker)
+        zahel.books.extend([oathbringer, words])
+        vivenna.books.append(warbreaker)
+        kaladin.books.extend([oathbringer, words])
+        db.session.add_all([series, vasher, zahel, kalad, peacegiver, vivenna, kaladin])
+        db.session.commit()
+
+        # refresh the committed characters first so only the traversals are counted
+        [character.id for character in (peacegiver, vivenna, zahel, vasher)]
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        self.assertEqual(peacegiver.all_aliases(), [kalad, vasher, zahel])
+        self.assertEqual(vivenna.all_aliases(), [])
+        self.assertEqual(zahel.all_appearances(), [oathbringer, warbreaker, words])
+        self.assertEqual(vasher.co_appearing(), [(kaladin, 2), (vivenna, 1)])
+        self.assertEqual(vasher.co_appearing(limit=1), [(kaladin, 2)])
+        self.assertEqual(len([s for s in statements if s != 'BEGIN']), 5)
+
+        # a parent cycle still terminates
+        vasher.parent = peacegiver
+        db.session.commit()
+        self.assertEqual(zahel.all_aliases(), [kalad, peacegiver, vasher])
+
+
+class RelatedCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def dirty(self, kind):
+        return set(dirty.id for dirty in RelatedDirty.query.filter_by(kind=kind))
+
+    def check_refresh(self, sparse):
+        series = Series(title='Mistborn')
+        vin, kelsier, sazed, elend, wayne = [Character(first_name=name, series=series)
+            for name in ('Vin', 'Kelsier', 'Sazed', 'Elend', 'Wayne')]
+        empire, ascension, ages = [Book(title=title) for title in ('The Final Empire', 'The Well of Ascension', 'Hero of Ages')]
+        for character, books in ((vin, (empire, ascension, ages)), (kelsier, (empire,)), (sazed, (empire, ascension, ages)),
+                (elend, (empire, ascension))):
+            for book in books:
+                character.books.append(book)
+        fantasy, heist, romance = Tag(name='fantasy'), Tag(name='heist'), Tag(name='romance')
+        db.session.add_all([series, vin, kelsier, sazed, elend, wayne, fantasy, heist, romance])
+        db.session.commit()
+        self.assertEqual(self.dirty('character'), {vin.id, kelsier.id, sazed.id, elend.id})
+
+        self.assertEqual(related.refresh('character', 2, sparse=sparse), 4)
+        self.assertEqual(self.dirty('character'), set())
+        self.assertEqual(vin.related(), [(sazed, 3), (elend, 2)])
+        self.assertEqual(kelsier.related(), [(vin, 1), (sazed, 1)])
+
+        # one new appearance only refreshes the rows it moves
+        wayne.add_book_appearance(ages)
+        db.session.commit()
+        self.assertEqual(self.dirty('character'), {wayne.id})
+        # only the books Wayne is in are read
+        self.assertEqual(set(row for row, book in related.load_pairs(related.character_incidence, {wayne.id})),
+            {vin.id, sazed.id, wayne.id})
+        self.assertEqual(related.refresh('character', 2, sparse=sparse), 3)
+        self.assertEqual(wayne.related(), [(vin, 1), (sazed, 1)])
+
+        # removals reach rows that listed the changed character
+        vin.remove_book_appearance(ages)
+        vin.remove_book_appearance(ascension)
+        db.session.commit()
+        related.refresh('character', 2, sparse=sparse)
+        incremental = {c.id: c.related() for c in (vin, kelsier, sazed, elend, wayne)}
+        related.refresh('character', 2, full=True, sparse=sparse)
+        self.assertEqual({c.id: c.related() for c in (vin, kelsier, sazed, elend, wayne)}, incremental)
+        self.assertEqual(sazed.related(), [(elend, 2), (vin, 1)])
+
+        # tags co-occur across object types, through the ORM and link_many
+        TagBase.tag_many([(empire, fantasy), (empire, heist), (ascension, fantasy), (vin, fantasy), (vin, heist)])
+        elend.add_tag(romance)
+        db.session.commit()
+        self.assertEqual(self.dirty('tag'), {fantasy.id, heist.id, romance.id})
+        self.assertEqual(set(row for row, owner in related.load_pairs(related.tag_incidence, {romance.id})),
+            {romance.id})
+        related.refresh('tag', 5, sparse=sparse)
+        self.assertEqual(fantasy.related(), [(heist, 2)])
+        self.assertEqual(romance.related(), [])
+
+        db.session.delete(vin)
+        db.session.commit()
+        self.assertIn(vin.id, self.dirty('character'))
+        related.refresh('character', 2, sparse=sparse)
+        related.refresh('tag', 5, sparse=sparse)
+        self.assertEqual(fantasy.related(), [(heist, 1)])
+
+    def test_refresh(self):
+        self.check_refresh(sparse=False)
+
+    @unittest.skipUnless(related.sparse_available(), 'requires NumPy and SciPy')
+    def test_refresh_sparse(self):
+        self.check_refresh(sparse=True)
+
+
+class TagModelCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_tag_many(self):
+        books = [Book(title='Book {}'.format(i)) for i in range(50)]
+        character = Character(first_name='Vin', series=Series(title='Mistborn'))
+        fantasy, heist = Tag(name='fantasy'), Tag(name='heist')
+        db.session.add_all(books + [character, fantasy, heist])
+        db.session.commit()
+        books[0].add_tag(heist)
+        db.session.commit()
+
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if not re.search('table_version|related_dirty|usage_count', statement) and statement != 'BEGIN':
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        added = TagBase.tag_many([(book, fantasy) for book in books] + [(books[0], heist), (books[1], heist),
+            (books[1], heist), (character, fantasy)])
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(added, 52)
+        # one membership query and one executemany per association table
+        self.assertEqual(len(statements), 4)
+        self.assertEqual(len(fantasy.books), 50)
+        self.assertTrue(books[1].is_tagged(heist))
+        self.assertTrue(character.is_tagged(fantasy))
+        self.assertEqual(TagBase.tag_many([(book, fantasy) for book in books]), 0)
+
+        self.assertEqual(TagBase.untag_many([(books[0], fantasy), (books[0], heist), (books[2], heist)]), 2)
+        self.assertFalse(books[0].is_tagged(fantasy))
+        self.assertFalse(books[0].is_tagged(heist))
+        self.assertEqual(len(fantasy.books), 49)
+
+
+class ReplicaCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.primary = os.path.join(self.folder, 'primary.db')
+        self.replica = os.path.join(self.folder, 'replica.db')
+        config = type('ReplicaConfig', (TestConfig,), {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.primary,
+            'SQLALCHEMY_BINDS': {'replica': 'sqlite:///' + self.replica}})
+        self.app = create_app(config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.folder)
+
+    def replicate(self):
+        source, target = sqlite3.connect(self.primary), sqlite3.connect(self.replica)
+        source.backup(target)
+        source.close()
+        target.close()
+
+    def test_reads_use_replica_until_client_writes(self):
+        db.session.add_all([Book(title='Replica Copy'), Book(title='Doomed')])
+        db.session.commit()
+        self.replicate()
+        # a write the replica has not caught up with
+        Book.query.get(1).title = 'Primary Copy'
+        db.session.commit()
+
+        for url in ('/books', '/books/1', '/search?q=copy', '/books/export'):
+            data = self.client.get(url).get_data(as_text=True)
+            self.assertIn('Replica Copy', data, url)
+            self.assertNotIn('Primary Copy', data, url)
+        self.assertNotIn('replica', db.session.info)
+
+        self.assertTrue(self.client.delete('/books/2').json['success'])
+        self.assertIsNone(Book.query.get(2))
+        data = self.client.get('/books').get_data(as_text=True)
+        self.assertIn('Primary Copy', data)
+        self.assertNotIn('Doomed', data)
+
+        self.app.config['REPLICA_LAG_WINDOW'] = 0
+        self.assertIn('Replica Copy', self.client.get('/books').get_data(as_text=True))
+
+
+class SQLiteProfileCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        config = type('FileConfig', (TestConfig,), {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.folder, 'test.db')})
+        self.app = create_app(config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.folder)
+
+    def test_pragmas_are_applied(self):
+        for name, value in self.app.config['SQLITE_PRAGMAS'].items():
+            applied = db.session.execute(text('PRAGMA {}'.format(name))).scalar()
+            self.assertEqual(str(applied).lower(), {'NORMAL': '1', 'ON': '1'}.get(value, str(value).lower()))
+
+    def test_concurrent_read_then_write(self):
+        db.session.add(Universe(title='Cosmere'))
+        db.session.commit()
+        both_read = threading.Barrier(2)
+        errors = []
+
+        def read_then_write(title):
+            with self.app.app_context():
+                try:
+                    Universe.query.filter_by(title='Cosmere').one()
+                    both_read.wait()
+                    db.session.add(Universe(title=title))
+                    db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=read_then_write, args=(title,)) for title in ('Roshar', 'Scadrial')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Universe.query.count(), 3)
+
+
+class CounterCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_counts_follow_writes(self):
+        cosmere = Universe(title='Cosmere')
+        mistborn, stormlight = Series(title='Mistborn', universe=cosmere), Series(title='Stormlight', universe=cosmere)
+        brandon, janci = Author(first_name='Brandon', last_name='Sanderson'), Author(first_name='Janci', last_name='Patterson')
+        empire = Book(title='The Final Empire', series=mistborn, universe=cosmere, author=brandon)
+        kings = Book(title='The Way of Kings', series=mistborn, universe=cosmere, author=brandon, coauthor=janci)
+        vin = Character(first_name='Vin', series=mistborn)
+        fantasy = Tag(name='fantasy')
+        db.session.add_all([empire, kings, vin, fantasy])
+        db.session.commit()
+        self.assertEqual((mistborn.book_count, stormlight.book_count, cosmere.book_count), (2, 0, 2))
+        self.assertEqual((brandon.book_count, janci.book_count), (2, 1))
+
+        # moving an expired book reaches both the old and the new series
+        kings.series = stormlight
+        kings.coauthor = None
+        db.session.commit()
+        self.assertEqual((mistborn.book_count, stormlight.book_count, janci.book_count), (1, 1, 0))
+
+        vin.add_book_appearance(empire)
+        vin.add_book_appearance(kings)
+        empire.add_tag(fantasy)
+        TagBase.tag_many([(vin, fantasy), (mistborn, fantasy)])
+        db.session.commit()
+        self.assertEqual((vin.appearance_count, fantasy.usage_count), (2, 3))
+
+        vin.remove_book_appearance(kings)
+        TagBase.untag_many([(mistborn, fantasy)])
+        db.session.delete(empire)
+        db.session.commit()
+        self.assertEqual((vin.appearance_count, fantasy.usage_count), (0, 1))
+        self.assertEqual((mistborn.book_count, cosmere.book_count, brandon.book_count), (0, 1, 1))
+
+    def test_recount(self):
+        series = Series(title='Mistborn')
+        db.session.add_all([Book(title='The Final Empire', series=series), Book(title='The Well of Ascension', series=series)])
+        db.session.commit()
+        db.session.execute(Series.__table__.update().values(book_count=7))
+        db.session.execute(Book.__table__.update().values(series_sort='Stale'))
+        db.session.commit()
+
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['library', 'recount'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(len(result.output.splitlines()), len(counters) + len(sort_keys))
+        # the command's app context removed the session on its way out
+        self.assertEqual(Series.query.filter_by(title='Mistborn').one().book_count, 2)
+        self.assertEqual(set(book.series_sort for book in Book.query), {'Mistborn'})
+        self.assertIn('<td><span>2</span></td>', self.app.test_client().get('/series').get_data(as_text=True))
+
+    def test_recounts_use_indexes(self):
+        for counter in counters:
+            statements = []
+            listener = lambda conn, cursor, statement, parameters, *args: statements.append((statement, parameters))
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            counter.recount(db.session, [1, 2])
+            event.remove(db.engine, 'before_cursor_execute', listener)
+            for statement, parameters in statements:
+                plan = ' '.join(row[-1] for row in
+                    db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters))
+                self.assertNotRegex(plan, r'\bSCAN\b', (counter.model.__name__, counter.name))
+        db.session.rollback()
+
+
+class ImportCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_import_books(self):
+        db.session.add_all([Series(title='Mistborn'), Author(first_name='Brandon', last_name='Sanderson'),
+            Book(title='Elantris')])
+        db.session.commit()
+
+        report = import_file(Book, io.StringIO(
+            'title,series,author,series_number\n'
+            'The Final Empire,Mistborn,Brandon Sanderson,1\n'
+            'Elantris,,Brandon Sanderson,\n'
+            'The Hero of Ages,Mistborn,Brandon Sanderson,3\n'
+            'Warbreaker,Nightblood,,\n'), 'csv', batch_size=2)
+
+        self.assertEqual(report.inserted, 2)
+        self.assertEqual([number for number, message in report.conflicts], [2])
+        self.assertEqual(report.errors, [(4, 'unknown series "Nightblood"')])
+        book = Book.query.filter_by(title='The Hero of Ages').one()
+        self.assertEqual((book.series.title, book.author.full_name, book.series_number), ('Mistborn', 'Brandon Sanderson', 3))
+        self.assertEqual([b for b, score in Book.search('hero', 10)], [book])
+        self.assertEqual((book.series.book_count, book.author.book_count), (2, 2))
+        self.assertEqual((book.series_sort, book.author_sort), ('Mistborn', 'Sanderson\x1fBrandon'))
+
+    def test_import_jsonl(self):
+        report = import_file(Universe, io.StringIO('{"title": "Cosmere"}\nnot json\n\n{"title": "Roshar", "moons": 3}\n'),
+            'jsonl')
+        self.assertEqual(report.inserted, 1)
+        self.assertEqual([number for number, message in report.errors], [2, 3])
+
+    def test_import_rejects_malformed_values(self):
+        report = import_file(Universe, io.StringIO('title\nCosmere\n"Roshar",extra\n'), 'csv')
+        self.assertEqual((report.inserted, report.errors), (1, [(2, '1 field(s) past the header')]))
+
+        report = import_file(Book, io.StringIO('{"title": ["Elantris"]}\n{"title": "Warbreaker", "series": {}}\n'
+            '{"title": "Mistborn", "author": ["Brandon Sanderson"]}\n'), 'jsonl')
+        self.assertEqual(report.inserted, 1)
+        self.assertEqual(report.errors, [(1, 'title must be a single value'), (3, 'unknown author "[\'Brandon Sanderson\']"')])
+
+
+class UploadCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        # the upload workers need their own connections, so use a file rather than a shared in-memory database
+        config = type('UploadConfig', (TestConfig,), {'UPLOAD_FOLDER': os.path.join(self.folder, 'spool'),
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.folder, 'test.db'), 'UPLOAD_RETRY_DELAY': 0,
+            'UPLOAD_RETRIES': 2, 'S3_BUCKET': 'library-test', 'S3_KEY': 'testing', 'S3_SECRET': 'testing',
+            'S3_REGION': 'us-east-1', 'S3_MAX_POOL_CONNECTIONS': 12})
+        self.app = create_app(config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.folder)
+
+    def post_upload(self, data=b'image bytes', filename='vin.png'):
+        self.login()
+        response = self.client.post('/upload', data={'file': FileStorage(io.BytesIO(data), filename, content_type='image/png')})
+        self.assertEqual(response.status_code, 302)
+        uploads.wait()
+        # end this session's read transaction so it sees the workers' commits
+        db.session.rollback()
+        return self.client.get('/uploads/{}'.format(Upload.query.count())).json
+
+    def test_s3_client_is_lazy(self):
+        self.assertIsNone(s3._client)
+        self.assertEqual(s3.meta.config.max_pool_connections, 12)
+        self.assertIs(s3.client, s3._client)
+
+        create_app(type('NoS3Config', (TestConfig,), {'S3_BUCKET': None}))
+        self.assertFalse(s3.configured)
+        self.assertEqual(self.client.get('/upload').status_code, 503)
+
+    def test_failed_upload_is_retried_and_reported(self):
+        self.app.config['S3_BUCKET'] = 'not a bucket name'
+        status = self.post_upload()
+        self.assertEqual((status['status'], status['attempts'], status['reference_id']), ('failed', 2, None))
+        self.assertTrue(os.path.exists(Upload.query.get(1).path))
+
+    def spool_upload(self, data, status, **kwargs):
+        os.makedirs(self.app.config['UPLOAD_FOLDER'], exist_ok=True)
+        path = os.path.join(self.app.config['UPLOAD_FOLDER'], status)
+        with open(path, 'wb') as spooled:
+            spooled.write(data)
+        sha256 = hashlib.sha256(data).hexdigest()
+        upload = Upload(filename=status + '.png', key=content_key(sha256), sha256=sha256, path=path, status=status,
+            **kwargs)
+        db.session.add(upload)
+        db.session.commit()
+        return upload
+
+    def test_resume_unfinished_uploads(self):
+        # the stored copy lets the resumed jobs finish without a transfer
+        db.session.add(Reference(key='stored/key', sha256=hashlib.sha256(b'image bytes').hexdigest()))
+        for status in ('pending', 'uploading', 'failed'):
+            self.spool_upload(b'image bytes', status, attempts=1)
+        self.spool_upload(b'other bytes', 'lost', attempts=2)
+        cli.register(self.app)
+
+        result = self.app.test_cli_runner().invoke(args=['library', 'resume-uploads'])
+        self.assertIn('Resumed 2 upload(s)', result.output)
+        db.session.rollback()
+        self.assertEqual([(u.status, u.reference_id, u.path) for u in Upload.query.order_by(Upload.id)][:3],
+            [('done', 1, None), ('done', 1, None), ('failed', None, Upload.query.get(3).path)])
+
+        # a retried failure gets every attempt again
+        self.app.config['S3_BUCKET'] = 'not a bucket name'
+        Upload.query.get(3).sha256 = Upload.query.get(4).sha256
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['library', 'resume-uploads', '--failed'])
+        self.assertIn('Upload 3 (failed.png): failed', result.output)
+        db.session.rollback()
+        self.assertEqual(Upload.query.get(3).attempts, 2)
+
+    def test_job_errors_are_recorded(self):
+        # linking to the stored copy succeeds, then removing the missing spool file raises
+        db.session.add(Reference(key='stored/key', sha256=hashlib.sha256(b'image bytes').hexdigest()))
+        upload = self.spool_upload(b'image bytes', 'pending')
+        os.remove(upload.path)
+        with self.assertLogs(self.app.logger, 'ERROR') as logs:
+            uploads.resume()
+            uploads.queue(lambda app: 1 / 0)
+            uploads.wait()
+        db.session.rollback()
+        self.assertEqual((Upload.query.get(1).status, Upload.query.get(1).reference_id), ('failed', None))
+        self.assertIn('No such file', Upload.query.get(1).error)
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('ZeroDivisionError', '\n'.join(logs.output))
+
+    def test_clean_failed_spools(self):
+        old = self.spool_upload(b'old', 'failed', created_at=datetime.utcnow() - timedelta(days=2)).id
+        recent = self.spool_upload(b'recent', 'pending').id
+        orphan = os.path.join(self.app.config['UPLOAD_FOLDER'], 'orphan')
+        open(orphan, 'wb').close()
+        os.utime(orphan, (0, 0))
+        cli.register(self.app)
+
+        result = self.app.test_cli_runner().invoke(args=['library', 'clean-uploads', '--older-than', '24'])
+        self.assertIn('Removed 2 spool file(s)', result.output)
+        db.session.rollback()
+        self.assertEqual(sorted(os.listdir(self.app.config['UPLOAD_FOLDER'])), ['pending'])
+        self.assertEqual((Upload.query.get(old).path, Upload.query.get(recent).status), (None, 'pending'))
+
+    @unittest.skipIf(moto is None, 'moto is not installed')
+    def test_upload_creates_reference(self):
+        with (getattr(moto, 'mock_aws', None) or moto.mock_s3)():
+            import boto3
+            s3 = boto3.client('s3', region_name='us-east-1')
+            s3.create_bucket(Bucket='library-test')
+            data = b'x' * (9 * 1024 * 1024)
+            status = self.post_upload(data)
+            key = content_key(hashlib.sha256(data).hexdigest())
+            self.assertEqual((status['status'], status['key']), ('done', key))
+            self.assertEqual(Upload.query.get(1).reference.key, key)
+            self.assertEqual(s3.head_object(Bucket='library-test', Key=key)['ContentLength'], 9 * 1024 * 1024)
+        self.assertEqual(os.listdir(self.app.config['UPLOAD_FOLDER']), [])
+
+    def test_duplicate_upload_links_existing_reference(self):
+        data = b'image bytes'
+        db.session.add(Reference(key='stored/key', sha256=hashlib.sha256(data).hexdigest()))
+        db.session.commit()
+
+        # a transfer would fail against this bucket, so a success means nothing was sent
+        self.app.config['S3_BUCKET'] = 'not a bucket name'
+        status = self.post_upload(data, 'copy.png')
+        self.assertEqual((status['status'], status['attempts'], status['key'], status['reference_id']),
+            ('done', 0, 'stored/key', 1))
+        self.assertEqual(Reference.query.count(), 1)
+        self.assertEqual(os.listdir(self.app.config['UPLOAD_FOLDER']), [])
+
+    @unittest.skipIf(moto is None or not thumbnails.available(), 'moto or Pillow is not installed')
+    def test_upload_generates_thumbnails(self):
+        from PIL import Image
+        image = io.BytesIO()
+        Image.new('RGB', (800, 400)).save(image, 'PNG')
+        self.app.config['THUMBNAIL_SIZES'] = (320, 1280)
+        with (getattr(moto, 'mock_aws', None) or moto.mock_s3)():
+            import boto3
+            s3 = boto3.client('s3', region_name='us-east-1')
+            s3.create_bucket(Bucket='library-test')
+            self.assertEqual(self.post_upload(image.getvalue())['status'], 'done')
+            reference = Upload.query.get(1).reference
+            self.assertEqual([(d.key, d.width) for d in reference.derivatives],
+                [(reference.key + '_320.webp', 320), (reference.key + '_320.jpg', 320)])
+            self.assertEqual(s3.head_object(Bucket='library-test', Key=reference.key + '_320.jpg')['ContentType'],
+                'image/jpeg')
+        self.assertEqual(os.listdir(self.app.config['UPLOAD_FOLDER']), [])
+
+    def test_best_derivative(self):
+        reference = Reference(key='abc/vin.png')
+        self.assertIsNone(reference.best_derivative(100))
+        for size in (640, 160, 320):
+            for format in ('webp', 'jpeg'):
+                reference.derivatives.append(ReferenceDerivative(size=size, format=format,
+                    key=derivative_key(reference.key, size, format), width=size, height=size // 2))
+        db.session.add(reference)
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(reference.best_derivative(200, 'webp').key, 'abc/vin_320.webp')
+        self.assertEqual(reference.best_derivative(160, 'jpeg').key, 'abc/vin_160.jpg')
+        self.assertIsNone(reference.best_derivative(2000))
+        self.assertIn('/abc/vin.png?', presigned_download(reference, 2000))
+        self.assertIn('/abc/vin_640.', presigned_download(reference, 500))
+
+    @unittest.skipUnless(thumbnails.available(), 'Pillow is not installed')
+    def test_make_thumbnails(self):
+        from PIL import Image
+        path = os.path.join(self.folder, 'original')
+        Image.new('RGBA', (800, 400)).save(path, 'PNG')
+        results = thumbnails.make_thumbnails(path, (160, 320, 1280), ('webp', 'jpeg'), 80)
+        self.assertEqual([(size, format, width, height) for size, format, output, width, height in results],
+            [(160, 'webp', 160, 80), (160, 'jpeg', 160, 80), (320, 'webp', 320, 160), (320, 'jpeg', 320, 160)])
+        self.assertTrue(all(os.path.exists(result[2]) for result in results))
+
+    def login(self, username='susan'):
+        if User.query.filter_by(username=username).first() is None:
+            user = User(username=username)
+            user.set_password('cat')
+            db.session.add(user)
+            db.session.commit()
+        self.client.post('/auth/login', data={'username': username, 'password': 'cat'})
+
+    def test_presign_requires_filename_and_login(self):
+        self.assertEqual(self.client.post('/api/uploads', json={'filename': 'vin.png'}).status_code, 302)
+        self.login()
+        self.assertEqual(self.client.post('/api/uploads', json={'filename': 'vin.png'}).status_code, 400)
+        self.assertEqual(self.client.get('/references/1/download').status_code, 404)
+
+    def test_uploads_are_private_to_their_owner(self):
+        self.login()
+        self.spool_upload(b'image bytes', 'pending', user_id=1)
+        self.assertEqual(self.client.get('/uploads/1').json['status'], 'pending')
+        self.client.get('/auth/logout')
+        self.assertEqual(self.client.get('/uploads/1').status_code, 302)
+        self.login('kelsier')
+        self.assertEqual(self.client.get('/uploads/1').status_code, 404)
+        self.assertEqual(self.client.post('/api/uploads/1/complete').status_code, 404)
+
+    @unittest.skipIf(moto is None, 'moto is not installed')
+    def test_presigned_upload_and_download(self):
+        with (getattr(moto, 'mock_aws', None) or moto.mock_s3)():
+            import boto3
+            s3 = boto3.client('s3', region_name='us-east-1')
+            s3.create_bucket(Bucket='library-test')
+            self.login()
+
+            response = self.client.post('/api/uploads', json={'filename': 'vin.png', 'content_type': 'image/png'})
+            presigned = response.json['request']
+            self.assertEqual((response.status_code, presigned['method'], presigned['fields']['Content-Type']),
+                (201, 'POST', 'image/png'))
+            policy = json.loads(base64.b64decode(presigned['fields']['policy']))
+            self.assertIn(['content-length-range', 1, self.app.config['UPLOAD_MAX_BYTES']], policy['conditions'])
+            key = response.json['upload']['key']
+            self.assertEqual(self.client.post(response.json['complete_url']).status_code, 409)
+
+            # the browser sends the bytes straight to S3
+            s3.put_object(Bucket='library-test', Key=key, Body=b'image bytes')
+            self.assertEqual(self.client.post(response.json['complete_url']).status_code, 200)
+            uploads.wait()
+            db.session.rollback()
+            completed = self.client.get('/uploads/1').json
+            stored = content_key(hashlib.sha256(b'image bytes').hexdigest())
+            self.assertEqual((completed['status'], completed['key']), ('done', stored))
+
+            download = self.client.get('/references/{}/download'.format(completed['reference_id']))
+            self.assertEqual(download.status_code, 302)
+            self.assertIn(stored, download.headers['Location'])
+
+            # the same bytes sent again are linked to the stored Reference
+            response = self.client.post('/api/uploads', json={'filename': 'copy.png', 'content_type': 'image/png'})
+            s3.put_object(Bucket='library-test', Key=response.json['upload']['key'], Body=b'image bytes')
+            self.client.post(response.json['complete_url'])
+            uploads.wait()
+            db.session.rollback()
+            self.assertEqual(self.client.get('/uploads/2').json['reference_id'], completed['reference_id'])
+            self.assertEqual([o['Key'] for o in s3.list_objects_v2(Bucket='library-test')['Contents']], [stored])
+
+    @unittest.skipIf(moto is None, 'moto is not installed')
+    def test_oversized_direct_upload_is_rejected(self):
+        with (getattr(moto, 'mock_aws', None) or moto.mock_s3)():
+            import boto3
+            s3 = boto3.client('s3', region_name='us-east-1')
+            s3.create_bucket(Bucket='library-test')
+            self.login()
+            self.app.config['UPLOAD_MAX_BYTES'] = 4
+
+            response = self.client.post('/api/uploads', json={'filename': 'vin.png', 'content_type': 'image/png'})
+            key = response.json['upload']['key']
+            s3.put_object(Bucket='library-test', Key=key, Body=b'image bytes')
+            for attempt in range(2):
+                completed = self.client.post(response.json['complete_url'])
+                self.assertEqual((completed.status_code, completed.json['upload']['status']), (413, 'failed'))
+            self.assertEqual(s3.list_objects_v2(Bucket='library-test')['KeyCount'], 0)
+            self.assertEqual(Reference.query.count(), 0)
+
+
+class StartupCase(unittest.TestCase):
+    statement = ('import sys; from config import Config; from app import create_app; '
+        'create_app(type("StartupConfig", (Config,), {"TESTING": True})); ')
+
+    def test_heavy_imports_are_deferred(self):
+        deferred = ['PIL', 'alembic', 'boto3', 'botocore', 'flask_migrate', 'moto', 'numpy', 'redis', 'scipy']
+        result = startup.run_python('-c', self.statement +
+            'print(" ".join(sorted({{m.split(".")[0] for m in sys.modules}} & set({!r}))))'.format(deferred))
+        self.assertEqual(result.stdout.strip(), '')
+
+    def test_cold_start_budget(self):
+        # about 1.5x a 0.7 s cold start; override with STARTUP_BUDGET (seconds) on slow machines
+        elapsed = startup.cold_start(self.statement)
+        self.assertLess(elapsed, float(os.environ.get('STARTUP_BUDGET', 1.5)))
+
+        # machine independent: the app measures about 1.4x the frameworks it is built on
+        baseline = startup.cold_start('import flask_bootstrap, flask_login, flask_sqlalchemy, flask_wtf, sqlalchemy.orm')
+        self.assertLess(elapsed, baseline * float(os.environ.get('STARTUP_BUDGET_RATIO', 1.75)))
+
+    def test_import_profile(self):
+        rows = startup.import_profile(self.statement)
+        packages = dict(startup.package_totals(rows))
+        self.assertIn('app', packages)
+        self.assertIn(('app.models', 1), [(module, depth) for module, self_us, cumulative_us, depth in rows])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file